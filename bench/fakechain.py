@@ -0,0 +1,146 @@
+import time
+import hashlib
+import threading
+from types import SimpleNamespace
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from src.session import keccak
+
+class Ledger:
+    # Contract state shared by every FakeChain, with a configurable latency
+    # for each call and for each transaction receipt
+    def __init__(self, rpc_latency=0.0, receipt_latency=0.0, workers=64):
+        self.rpc_latency = rpc_latency
+        self.receipt_latency = receipt_latency
+        self.songs = {}
+        self.sessions = {}
+        self.users = {}
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='receipts')
+
+    def rpc(self, name):
+        with self.lock:
+            self.calls[name] += 1
+        if self.rpc_latency:
+            time.sleep(self.rpc_latency)
+
+    def receipt(self, effect):
+        def mine():
+            if self.receipt_latency:
+                time.sleep(self.receipt_latency)
+            return SimpleNamespace(status=int(effect() is not False))
+        return self.pool.submit(mine)
+
+    def add_song(self, id, data, chunk_len, duration=60):
+        hashes = [keccak(data[i:i+chunk_len]) for i in range(0, len(data), chunk_len)]
+        self.songs[id] = SimpleNamespace(length=len(data), duration=duration, hashes=hashes, distributors=[])
+
+    def close(self):
+        self.pool.shutdown()
+
+class FakeChain:
+    # Implements the part of Chain used by Server, Session, Buffer and Download
+    def __init__(self, ledger, address, url='', index_lag=None):
+        self.ledger = ledger
+        # Seconds the event index runs behind the chain, None without an index
+        self.index_lag = index_lag
+        self.account = SimpleNamespace(address=address)
+        ledger.users[address] = SimpleNamespace(name=address, url=url, balance=1e9)
+
+    def edit_url(self, url):
+        self.ledger.rpc('edit_url')
+        self.ledger.users[self.account.address].url = url
+        return SimpleNamespace(status=1)
+
+    def distribute(self, id):
+        self.ledger.rpc('distribute')
+        self.ledger.songs[id].distributors.append(self.account.address)
+        return SimpleNamespace(status=1)
+
+    def get_user_info(self, address=None):
+        self.ledger.rpc('users')
+        user = self.ledger.users[address or self.account.address]
+        return True, user.name, '', user.url, user.balance, False
+
+    def get_contract_balance(self):
+        return self.get_user_info()[4]
+
+    def get_song_metadata(self, id):
+        self.ledger.rpc('songs')
+        self.ledger.rpc('chunks_length')
+        song = self.ledger.songs[id]
+        return song.length, song.duration, len(song.hashes)
+
+    def get_merkle_root(self, id):
+        self.ledger.rpc('songs')
+        return None
+
+    def get_chunk_hashes(self, id):
+        self.ledger.rpc('chunks_length')
+        self.ledger.rpc('chunk_hashes')
+        return self.ledger.songs[id].hashes
+
+    def get_distributors(self, id):
+        self.ledger.rpc('get_distributors')
+        return list(self.ledger.songs[id].distributors)
+
+    def create_session(self, song_id, distributor=None):
+        self.ledger.rpc('create_session')
+        if distributor is None:
+            distributor = self.ledger.songs[song_id].distributors[0]
+        id = self.gen_session_id(self.account.address, distributor, song_id)
+        self.ledger.sessions[id] = SimpleNamespace(
+            active=True, listener=self.account.address, distributor=distributor, song=song_id,
+            paid=[None] * len(self.ledger.songs[song_id].hashes))
+        return id, distributor
+
+    def gen_session_id(self, sender, distributor, song_id):
+        return '0x' + hashlib.sha3_256(f'{sender}{distributor}{song_id}'.encode()).hexdigest()
+
+    def is_session_open(self, id):
+        active,addr,_,_,_,_ = self.get_session_info(id)
+        return active and addr == self.account.address
+
+    def get_session_info(self, id):
+        self.ledger.rpc('sessions')
+        s = self.ledger.sessions[id]
+        return s.active, s.listener, s.distributor, s.song, 1.0, 1.0
+
+    def get_chunk_async(self, id, index):
+        self.ledger.rpc('get_chunk')
+        session = self.ledger.sessions[id]
+        def pay():
+            if session.paid[index] is not None:
+                return False
+            session.paid[index] = time.monotonic()
+        return self.ledger.receipt(pay)
+
+    def get_chunk(self, id, index):
+        return self.get_chunk_async(id, index).result()
+
+    def get_paid_chunks(self, id, chunks_len, index=None):
+        paid = self.ledger.sessions[id].paid
+        if self.index_lag is not None:
+            # Event index only holds payments mined index_lag seconds ago
+            now = time.monotonic()
+            indexed = {i for i,t in enumerate(paid) if t is not None and now - t >= self.index_lag}
+            if index is None or index in indexed:
+                return indexed
+            # Read the logs up to the latest block
+            self.ledger.rpc('eth_getLogs')
+        else:
+            self.ledger.rpc('paid_bitmap')
+        return {i for i,t in enumerate(paid) if t is not None}
+
+    def close_session(self, id):
+        self.ledger.rpc('close_session')
+        def close():
+            self.ledger.sessions[id].active = False
+        return self.ledger.receipt(close).result()
+
+    def sign_message(self, msg):
+        return hashlib.sha256(f'{self.account.address}{msg}'.encode()).hexdigest()
+
+    def verify_message(self, msg, sig, address):
+        return sig == hashlib.sha256(f'{address}{msg}'.encode()).hexdigest()
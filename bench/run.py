@@ -0,0 +1,166 @@
+# End-to-end benchmarks of the serving and listening paths against a fake chain
+#   python -m bench.run [--listeners N] [--rpc-latency MS] [--receipt-latency MS] [--index-lag MS] [--json FILE]
+import os
+import json
+import time
+import socket
+import argparse
+import tempfile
+import threading
+from functools import partial
+from contextlib import redirect_stdout
+from src.server import Server
+from src.session import Session
+from src.buffer import Buffer
+from src.sink import NullSink
+from src.metrics import metrics
+from bench.fakechain import Ledger, FakeChain
+CHUNK_LEN = 30000
+SONG_ID = '0x' + '11' * 32
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+class Bench:
+    def __init__(self, ledger, song_len, index_lag=None):
+        self.ledger = ledger
+        # Serve a random song from a real server over loopback TLS
+        os.makedirs('downloads', exist_ok=True)
+        data = os.urandom(song_len)
+        with open(f'downloads/{SONG_ID}.mp3', 'wb') as f:
+            f.write(data)
+        ledger.add_song(SONG_ID, data, CHUNK_LEN)
+        chain = FakeChain(ledger, '0xdistributor', index_lag=index_lag)
+        self.server = Server(free_port(), chain, CHUNK_LEN)
+        chain.edit_url(self.server.url)
+        chain.distribute(SONG_ID)
+        self.server.new_song((SONG_ID, 'bench', 'bench'))
+        self.handle = threading.Thread(target=self.server.run)
+        self.handle.start()
+        self.song = (SONG_ID, 'bench', 'bench', 1.0)
+
+    def stream(self, listener):
+        # Fetch the whole song in one session, timing every chunk from its payment
+        session = Session(FakeChain(self.ledger, f'0xlistener{listener}'), CHUNK_LEN)
+        start = time.perf_counter()
+        session.create(self.song)
+        issued = {}
+        pay = session.pay_chunk_async
+        def timed_pay(index):
+            issued[index] = time.perf_counter()
+            return pay(index)
+        session.pay_chunk_async = timed_pay
+        first, latencies = None, []
+        for i, _ in enumerate(session.get_chunks(range(session.chunks_len))):
+            now = time.perf_counter()
+            first = first or now - start
+            latencies.append(now - issued[i])
+        session.close()
+        return first, latencies
+
+    def streaming(self, listeners):
+        results = [None] * listeners
+        def run(i):
+            results[i] = self.stream(i)
+        calls = sum(self.ledger.calls.values())
+        start = time.perf_counter()
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(listeners)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        latencies = [l for r in results if r for l in r[1]]
+        firsts = [r[0] for r in results if r]
+        return {
+            "listeners": listeners,
+            "chunks": len(latencies),
+            "chunks_per_s": len(latencies) / elapsed,
+            "ttfc_ms": 1000 * sum(firsts) / max(len(firsts), 1),
+            "rpcs_per_chunk": (sum(self.ledger.calls.values()) - calls) / max(len(latencies), 1),
+            "p50_ms": 1000 * percentile(latencies, 50),
+            "p99_ms": 1000 * percentile(latencies, 99)
+        }
+
+    def listening(self, speed):
+        # Play the song through a buffer with a simulated player
+        session = Session(FakeChain(self.ledger, '0xplayer'), CHUNK_LEN)
+        buffer = Buffer('bench', session, sink=partial(NullSink, speed=speed))
+        start = time.perf_counter()
+        session.create(self.song)
+        buffer.start()
+        play = buffer.sink.play
+        first_audio = []
+        def timed_play():
+            first_audio.append(time.perf_counter() - start)
+            play()
+        buffer.sink.play = timed_play
+        # Keep the player's progress line out of the report
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            try:
+                buffer.prudent_loading()
+                buffer.wait()
+            finally:
+                buffer.close()
+                session.close()
+        return {
+            "speed": speed,
+            "time_to_audio_ms": 1000 * first_audio[0] if first_audio else None,
+            "elapsed_s": time.perf_counter() - start
+        }
+
+    def close(self):
+        self.server.close()
+        self.handle.join()
+        self.ledger.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark serving and listening against a fake chain')
+    parser.add_argument('--listeners', type=int, default=32, help='concurrent listeners on one server')
+    parser.add_argument('--song-len', type=int, default=3000000, help='bytes of the song served')
+    parser.add_argument('--rpc-latency', type=float, default=0, help='ms of every chain call')
+    parser.add_argument('--receipt-latency', type=float, default=0, help='ms until a transaction is mined')
+    parser.add_argument('--index-lag', type=float, default=1000, help='ms the distributor\'s event index runs behind the chain')
+    parser.add_argument('--speed', type=float, default=30, help='playback speed of the listening run')
+    parser.add_argument('--json', help='also write results to this file')
+    args = parser.parse_args()
+
+    ledger = Ledger(args.rpc_latency / 1000, args.receipt_latency / 1000)
+    # Time every stage of the listeners' sessions
+    metrics.enable()
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        bench = Bench(ledger, args.song_len, args.index_lag / 1000)
+        try:
+            results = {
+                "single": bench.streaming(1),
+                "concurrent": bench.streaming(args.listeners),
+                "listen": bench.listening(args.speed),
+                "calls": dict(ledger.calls),
+                "stages": metrics.snapshot()["timers"]
+            }
+        finally:
+            bench.close()
+            os.chdir(cwd)
+    for name in ('single', 'concurrent'):
+        r = results[name]
+        print(f"{name:>10}: {r['listeners']} listeners, {r['chunks']} chunks, {r['chunks_per_s']:.1f} chunks/s, "
+            f"ttfc {r['ttfc_ms']:.1f} ms, {r['rpcs_per_chunk']:.2f} rpcs/chunk, "
+            f"p50 {r['p50_ms']:.1f} ms, p99 {r['p99_ms']:.1f} ms")
+    if results['listen']['time_to_audio_ms'] is not None:
+        print(f"{'listen':>10}: first audio after {results['listen']['time_to_audio_ms']:.1f} ms")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=4)
+
+if __name__ == '__main__':
+    main()
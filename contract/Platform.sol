@@ -10,6 +10,12 @@ contract Platform {
     mapping(bytes32 => uint256) private distributor_index;
     bytes32[] public song_list;
 
+    event SongUploaded(bytes32 indexed song, address indexed author);
+    event DistributorChanged(bytes32 indexed song, address indexed distributor, bool distributing);
+    event SessionCreated(bytes32 indexed session, address indexed listener, address indexed distributor, bytes32 song, uint256 price, uint256 balance);
+    event ChunkPaid(bytes32 indexed session, uint256 index, uint256 amount);
+    event SessionClosed(bytes32 indexed session);
+
     modifier onlyOwner() {
         require(msg.sender == owner, "Only owner is allowed");
         _;
@@ -54,6 +60,8 @@ contract Platform {
         uint256 price;
         uint256 length;
         uint256 duration;
+        bytes32 root;
+        uint256 chunks_count;
         bytes32[] chunks;
         address[] distributors;
     }
@@ -65,7 +73,7 @@ contract Platform {
         bytes32 song;
         uint256 price;
         uint256 balance;
-        bool[] is_chunk_paid;
+        uint256[] paid_words; // one bit per chunk
     }
 
     // ADMIN MANAGEMENT
@@ -99,36 +107,76 @@ contract Platform {
     // SONG MANAGEMENT
     //  - Upload Song
     function upload_song(string memory _name, uint _price, uint _length, uint _duration, bytes32[] memory _chunks) external userExists {
-        require(_chunks.length > 0 && _price % _chunks.length == 0, "Price is not divisible by amount of chunks");
-        require(_price / _chunks.length % DIST_FEE == 0, "Chunk price is not divisible by distributor fee");
+        bytes32 song = create_song(_name, _price, _length, _duration, _chunks.length);
+        songs[song].chunks = _chunks;
+    }
+
+    //  - Upload Song committing only to the Merkle root of its chunk hashes
+    function upload_song_merkle(string memory _name, uint _price, uint _length, uint _duration, bytes32 _root, uint _chunks_count) external userExists {
+        bytes32 song = create_song(_name, _price, _length, _duration, _chunks_count);
+        songs[song].root = _root;
+    }
+
+    function create_song(string memory _name, uint _price, uint _length, uint _duration, uint _chunks_count) internal returns (bytes32) {
+        require(_chunks_count > 0 && _price % _chunks_count == 0, "Price is not divisible by amount of chunks");
+        require(_price / _chunks_count % DIST_FEE == 0, "Chunk price is not divisible by distributor fee");
         bytes32 song = gen_song_id(_name, msg.sender);
         require(!songs[song].exists, "Song is already uploaded");
 
         //Create and upload song's object
-        Song memory object;
+        Song storage object = songs[song];
         object.exists = true;
         object.author = msg.sender;
         object.name = _name;
         object.price = _price;
         object.length = _length;
         object.duration = _duration;
-        object.chunks = _chunks;
-        songs[song] = object;
+        object.chunks_count = _chunks_count;
 
         // Set up distribution list
-        songs[song].distributors.push(address(0x0));
+        object.distributors.push(address(0x0));
         bytes32 hash = get_distributor_hash(song, msg.sender);
-        distributor_index[hash] = songs[song].distributors.length;
-        songs[song].distributors.push(msg.sender);
+        distributor_index[hash] = object.distributors.length;
+        object.distributors.push(msg.sender);
 
         //Add song id to list
         song_list.push(song);
+        emit SongUploaded(song, msg.sender);
+        emit DistributorChanged(song, msg.sender, true);
+        return song;
     }
 
     function gen_song_id(string memory _name, address _sender) public pure returns (bytes32) {
         return keccak256(abi.encodePacked(_name, _sender));
     }
 
+    //  - List songs
+    function song_count() external view returns (uint) {
+        return song_list.length;
+    }
+
+    function song_page(uint start, uint count) external view returns (bytes32[] memory ids, bool[] memory valid, address[] memory authors, string[] memory names, uint256[] memory prices) {
+        if (start > song_list.length) {
+            start = song_list.length;
+        }
+        if (count > song_list.length - start) {
+            count = song_list.length - start;
+        }
+        ids = new bytes32[](count);
+        valid = new bool[](count);
+        authors = new address[](count);
+        names = new string[](count);
+        prices = new uint256[](count);
+        for (uint i = 0; i < count; i++) {
+            Song storage song_obj = songs[song_list[start + i]];
+            ids[i] = song_list[start + i];
+            valid[i] = song_obj.is_valid;
+            authors[i] = song_obj.author;
+            names[i] = song_obj.name;
+            prices[i] = song_obj.price + compute_distributor_fee(song_obj.price);
+        }
+    }
+
     //  - Validate Song
     function manage_validation(bytes32 song) external songExists(song) {
         require(users[msg.sender].is_validator, "User is not validator");
@@ -139,8 +187,8 @@ contract Platform {
     function edit_price(bytes32 song, uint256 _price) external songExists(song) {
         Song storage song_obj = songs[song];
         require(msg.sender == song_obj.author, "Sender is not the author of the song");
-        require(_price % song_obj.chunks.length == 0, "Price is not divisible by amount of chunks");
-        require(_price / song_obj.chunks.length % DIST_FEE == 0, "Chunk price is not divisible by distributor fee");
+        require(_price % song_obj.chunks_count == 0, "Price is not divisible by amount of chunks");
+        require(_price / song_obj.chunks_count % DIST_FEE == 0, "Chunk price is not divisible by distributor fee");
         song_obj.price = _price;
     }
 
@@ -161,6 +209,7 @@ contract Platform {
         require(distributor_index[hash] == 0, "Already distributing");
         distributor_index[hash] = songs[song].distributors.length;
         songs[song].distributors.push(msg.sender);
+        emit DistributorChanged(song, msg.sender, true);
     }
 
     //  - Cancel distribution
@@ -168,16 +217,35 @@ contract Platform {
         require(is_distributing(song, msg.sender), "Song is not being distributed");
         Song storage song_obj = songs[song];
         bytes32 hash = get_distributor_hash(song, msg.sender);
-        for(uint256 i = distributor_index[hash]; i < song_obj.distributors.length - 1; i++) {
-            song_obj.distributors[i] = song_obj.distributors[i+1];
+        // Move the last distributor into the freed slot
+        uint256 index = distributor_index[hash];
+        uint256 last = song_obj.distributors.length - 1;
+        if (index != last) {
+            address moved = song_obj.distributors[last];
+            song_obj.distributors[index] = moved;
+            distributor_index[get_distributor_hash(song, moved)] = index;
         }
         song_obj.distributors.pop();
         distributor_index[hash] = 0;
+        emit DistributorChanged(song, msg.sender, false);
+    }
+
+    function get_distributors(bytes32 song) external view returns (address[] memory) {
+        return songs[song].distributors;
     }
 
     function is_distributing(bytes32 song, address distributor) public view returns (bool) {
         return distributor_index[get_distributor_hash(song, distributor)] > 0;
     }
+
+    //  - Check several songs at once
+    function distributing_page(bytes32[] calldata _songs, address distributor) external view returns (bool[] memory) {
+        bool[] memory page = new bool[](_songs.length);
+        for (uint i = 0; i < _songs.length; i++) {
+            page[i] = is_distributing(_songs[i], distributor);
+        }
+        return page;
+    }
     
     // LISTENING MANAGEMENT
     //  - Create session
@@ -199,16 +267,13 @@ contract Platform {
         object.song = _song;
         object.price = song_obj.price;
         object.balance = required_balance;
+        // Payment state is packed in words of 256 chunks
+        object.paid_words = new uint256[]((song_obj.chunks_count + 255) / 256);
 
         // transfer balance
         users[msg.sender].balance -= object.balance;
         sessions[session] = object;
-
-        // Initialize is_paid array
-        Session storage session_obj = sessions[session];
-        for(uint i = 0; i < song_obj.chunks.length; i++) {
-            session_obj.is_chunk_paid.push(false);
-        }
+        emit SessionCreated(session, msg.sender, _distributor, _song, object.price, object.balance);
     }
 
     // - Compute distributors fee (10%)
@@ -227,7 +292,7 @@ contract Platform {
     }
 
     function chunks_length(bytes32 song) external view returns (uint) {
-        return songs[song].chunks.length;
+        return songs[song].chunks_count;
     }
 
     //  - Pay for a given chunk
@@ -235,17 +300,20 @@ contract Platform {
         Session storage session_obj = sessions[session];
         Song storage song_obj = songs[session_obj.song];
         require(msg.sender == session_obj.listener, "User is not allowed to pay for chunk");
-        require(!session_obj.is_chunk_paid[chunk_index], "Chunk has already been paid");
+        require(chunk_index < song_obj.chunks_count, "Chunk does not exist");
+        uint256 bit = 1 << (chunk_index % 256);
+        require(session_obj.paid_words[chunk_index / 256] & bit == 0, "Chunk has already been paid");
 
         // Distribute balance
-        uint author_compensation = session_obj.price / song_obj.chunks.length;
+        uint author_compensation = session_obj.price / song_obj.chunks_count;
         uint dist_compensation = compute_distributor_fee(author_compensation);
         session_obj.balance -= author_compensation + dist_compensation;
         users[song_obj.author].balance += author_compensation;
         users[session_obj.distributor].balance += dist_compensation;
 
         // Mark as paid
-        session_obj.is_chunk_paid[chunk_index] = true;
+        session_obj.paid_words[chunk_index / 256] |= bit;
+        emit ChunkPaid(session, chunk_index, author_compensation + dist_compensation);
     }
 
     //  - Check chunk
@@ -253,8 +321,29 @@ contract Platform {
         return songs[song].chunks[index] == _chunk;
     }
 
+    //  - Get a page of chunk hashes
+    function chunk_hashes(bytes32 song, uint start, uint count) external view returns (bytes32[] memory) {
+        bytes32[] storage chunks = songs[song].chunks;
+        if (start >= chunks.length) {
+            return new bytes32[](0);
+        }
+        if (count > chunks.length - start) {
+            count = chunks.length - start;
+        }
+        bytes32[] memory page = new bytes32[](count);
+        for (uint i = 0; i < count; i++) {
+            page[i] = chunks[start + i];
+        }
+        return page;
+    }
+
     function is_chunk_paid(bytes32 session, uint index) external view returns (bool) {
-        return sessions[session].is_chunk_paid[index];
+        return (sessions[session].paid_words[index / 256] >> (index % 256)) & 1 == 1;
+    }
+
+    //  - Get every paid chunk of a session at once, bit i of word j is chunk 256*j + i
+    function paid_bitmap(bytes32 session) external view returns (uint256[] memory) {
+        return sessions[session].paid_words;
     }
 
     //  - Close session
@@ -268,5 +357,6 @@ contract Platform {
         // Deactivate session
         session_obj.balance = 0;
         session_obj.active = false;
+        emit SessionClosed(session);
     }
 }
\ No newline at end of file
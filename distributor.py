@@ -0,0 +1,97 @@
+# Headless distributor, serves songs of the library without any prompt
+#   python distributor.py [config file]
+# Config file, every key but "chain" is optional:
+#   {
+#       "chain": "config.json",       chain url, contract and key, as written by iotamss.py
+#       "host": "0.0.0.0",            interface the server binds to
+#       "public_host": "example.org", name published on chain, defaults to host
+#       "port": 10000,
+#       "songs": ["0x..."],           songs to serve, defaults to every verified song of downloads/
+#       "chunk_len": 30000,           bytes per chunk of songs uploaded without a chunk index
+#       "undistribute_on_exit": false
+#   }
+import sys
+import json
+import signal
+import threading
+from src.chain import Chain
+from src.server import Server
+from src.library import Library
+CONFIG_FILE = "distributor.json"
+# Must match the chunk length songs were uploaded with
+CHUNK_LEN = 30000
+PORT = 10000
+
+def load_config(filename):
+    with open(filename, 'r') as f:
+        config = json.load(f)
+    if "chain" not in config:
+        raise Exception(f'No chain config file in {filename}')
+    return config
+
+class Distributor:
+    def __init__(self, config):
+        self.config = config
+        self.chain = Chain(config["chain"], interactive=False)
+        self.library = Library(self.chain, config.get("chunk_len", CHUNK_LEN))
+        self.server = None
+        self.handle = None
+        self.stopped = threading.Event()
+
+    def songs(self):
+        songs = self.library.songs()
+        if "songs" not in self.config:
+            return songs
+        wanted = set(self.config["songs"])
+        missing = wanted - {id for id,_,_ in songs}
+        if missing:
+            print(f'Not in the library or not valid on chain: {", ".join(sorted(missing))}')
+        return [s for s in songs if s[0] in wanted]
+
+    def start(self):
+        songs = self.songs()
+        self.server = Server(self.config.get("port", PORT), self.chain, self.library.chunk_len,
+            host=self.config.get("host", 'localhost'), public_host=self.config.get("public_host"))
+        # Answer session and payment checks from the contract's events
+        self.chain.start_indexer()
+        # Only send transactions for what changed since the last run, as read from
+        # the contract since a new container has no index yet
+        if self.chain.get_user_info()[3] != self.server.url and not self.chain.edit_url(self.server.url).status:
+            raise Exception('Execution failed (edit_url)')
+        distributing = self.library.distributing((id for id,_,_ in songs), indexed=False)
+        pending = [(song, self.chain.distribute_async(song[0])) for song in songs if song[0] not in distributing]
+        for song in songs:
+            if song[0] in distributing:
+                self.server.new_song(song)
+        for song, receipt in pending:
+            if receipt.result().status:
+                self.server.new_song(song)
+            else:
+                print(f'Execution failed (distribute {song[0]})')
+        self.handle = threading.Thread(target=self.server.run)
+        self.handle.start()
+
+    def stop(self, *args):
+        self.stopped.set()
+
+    def close(self):
+        if self.server is not None:
+            if self.config.get("undistribute_on_exit", False):
+                self.chain.undistribute_all(self.server.songs.keys())
+            self.server.close()
+            if self.handle is not None:
+                self.handle.join()
+        self.chain.stop_indexer()
+        print('Server Closed')
+
+if __name__ == '__main__':
+    distributor = Distributor(load_config(sys.argv[1] if len(sys.argv) > 1 else CONFIG_FILE))
+    signal.signal(signal.SIGINT, distributor.stop)
+    signal.signal(signal.SIGTERM, distributor.stop)
+    try:
+        distributor.start()
+        print(f'Serving {len(distributor.server.songs)} songs')
+        while not distributor.stopped.wait(1):
+            pass
+    finally:
+        distributor.close()
@@ -1,19 +1,29 @@
 import os
-import glob
+import sys
 import signal
 import warnings
 import threading
-from tkinter import filedialog
 from src.server import Server
-from src.session import Session
+from src.session import Session, LocalSession
+from src.download import Download
 from src.buffer import Buffer
 from src.upload import Upload
+from src.ingest import Ingest, read_manifest
 from src.chain import Chain
+from src.metrics import metrics
+from src.health import HealthCache
+from src.library import Library
 MAGIC_BYTES = b'ID3'
 CHUNK_LEN = 30000
+# Audio in each chunk of new songs, cut on MP3 frames
+CHUNK_MS = 2000
+# Store only the Merkle root of new songs' chunk hashes on chain
+MERKLE_UPLOADS = True
+# Dump stage timings and chain calls of every session to tmp/metrics
+METRICS = False
 
 class User:
-    def __init__(self):
+    def __init__(self, interactive=True):
         print("""
        __      __   _                           
        \ \    / /__| |__ ___ _ __  ___          
@@ -25,20 +35,25 @@ class User:
  |  _/ _ \  | | (_) || |/ _ \___| |\/| \__ \__ \\
   \__\___/ |___\___/ |_/_/ \_\  |_|  |_|___/___/                                                                                                                                      
     """)
-        # Connect to chain as a user
-        self.chain = Chain()
+        # Connect to chain as a user, without prompting unless interactive
+        self.chain = Chain(interactive=interactive)
         self.name = self.chain.get_user_info()[1]
         # Initialize state
         self.serving = False
         self.session = None
         self.server = None
+        # Latency, throughput and failures of distributors seen in past sessions
+        self.health = HealthCache()
+        # Songs held locally, verified once against the chain
+        self.library = Library(self.chain, CHUNK_LEN)
         # Set handler for Ctrl+C signal
         signal.signal(signal.SIGINT, self.handler)
         warnings.filterwarnings("ignore")
+        metrics.enable(METRICS)
 
     def listen(self, song):
         _, name, auth, _ = song
-        self.session = Session(self.chain, CHUNK_LEN)
+        self.session = self.local_session(song) or Session(self.chain, CHUNK_LEN, health=self.health)
         buffer = Buffer(f'{name} by {auth}', self.session)
         while True and self.session.active:
             # Attempt to listen to song until completion
@@ -50,8 +65,7 @@ class User:
                 # Load only when necessary
                 buffer.prudent_loading()
                 # Wait for song or session to end
-                while self.session.active and buffer.running:
-                    continue
+                buffer.wait()
                 break
             except Exception as e:
                 print(e)
@@ -63,41 +77,47 @@ class User:
                     self.session.close()
                 if self.session.on_chain:
                     self.session.close_on_chain()
+                    # Only what was measured since the previous session's dump
+                    metrics.dump(f'tmp/metrics/{self.session.id}.json', reset=True)
+
+    def local_session(self, song):
+        # Songs we distribute are played from their file, still paying every chunk
+        filename = f'downloads/{song[0]}.mp3'
+        if not os.path.exists(filename) or not self.chain.is_distributing(song[0]):
+            return None
+        session = LocalSession(self.chain, CHUNK_LEN, filename)
+        if not session.check(song):
+            session.close()
+            return None
+        return session
 
     def download(self, song):
         song_id, name, auth, _ = song
         if not os.path.exists('downloads'):
             os.makedirs('downloads')
-        self.session = Session(self.chain, CHUNK_LEN)
+        # Download from several distributors in parallel
+        self.session = Download(self.chain, song, CHUNK_LEN, health=self.health)
         print()
-        while True and self.session.active:
-            # Attempt to download until completion
-            try:
-                self.session.create(song)
-                with open(f'downloads/{song_id}.mp3', 'wb') as fd:
-                    fd.seek(0)
-                    fd.truncate()
-                    i = 0
-                    while self.session.active and i < self.session.chunks_len:
-                        fd.write(self.session.get_chunk(i))
-                        fd.flush()
-                        print(f"{name} by {auth}: {'{:.01%}'.format((i+1)/self.session.chunks_len)}", end='\r')
-                        i +=1
-                print()
-                return
-            except Exception as e:
-                print(e)
-                if str(e).startswith('\nInsufficient'):
-                    break
-            finally:
-                if self.session.active:
-                    self.session.close()
-                if self.session.on_chain:
-                    self.session.close_on_chain()
+        try:
+            while True and self.session.active:
+                # Attempt to download until completion
+                try:
+                    self.session.run(f'downloads/{song_id}.mp3')
+                    print()
+                    return
+                except Exception as e:
+                    print(e)
+                    if str(e).startswith('\nInsufficient'):
+                        break
+                    # Chunks already paid are fetched by the next attempt
+                    self.session.disconnect_sessions()
+        finally:
+            # Only once done or stopped
+            self.session.close_sessions()
     
     def upload(self, src_file):
         # Process file
-        upload = Upload(src_file, CHUNK_LEN)
+        upload = Upload(src_file, CHUNK_LEN, MERKLE_UPLOADS, chunk_ms=CHUNK_MS)
         # Upload song to smart contract
         upload.id = self.chain.upload(upload)
         if not upload.id:
@@ -108,6 +128,24 @@ class User:
         upload.save()
         self.serve((upload.id, upload.name, self.name), True)
 
+    def ingest(self, source, price=None, serve=False):
+        # Upload a whole directory or manifest without prompting
+        entries = [e for e in read_manifest(source, price) if valid_audio(e[0])]
+        ingest = Ingest(self.chain, CHUNK_LEN, MERKLE_UPLOADS, CHUNK_MS)
+        uploaded = ingest.run(entries)
+        print(f'\nUploaded {len(uploaded)} of {len(entries)} songs')
+        if not uploaded or not serve:
+            return
+        # Authors distribute their songs from upload, start serving them all at once
+        if not self.serving:
+            try:
+                self.start_server()
+            except Exception as e:
+                print(e)
+                return
+        for upload in uploaded:
+            self.server.new_song((upload.id, upload.name, self.name))
+
     def start_server(self):
         # Start server on a free port
         port = 10000
@@ -115,8 +153,10 @@ class User:
             try:
                 # Start server
                 self.server = Server(port, self.chain, CHUNK_LEN)
-                # Set url in Smart Contract
-                if not self.chain.edit_url(self.server.url).status:
+                # Answer session and payment checks from the contract's events
+                self.chain.start_indexer()
+                # Set url in Smart Contract, unless already published
+                if self.chain.get_user_info()[3] != self.server.url and not self.chain.edit_url(self.server.url).status:
                     self.exit()
                     raise Exception('Execution failed')
                 self.serving = True
@@ -138,6 +178,22 @@ class User:
                 print('Execution failed')
                 return
         self.server.new_song(song)
+
+    def serve_library(self):
+        # Serve every verified song of the library, registering only where needed
+        songs = self.library.songs()
+        if not songs:
+            return
+        if not self.serving:
+            try:
+                self.start_server()
+            except Exception as e:
+                print(e)
+                return
+        distributing = self.library.distributing((id for id,_,_ in songs), indexed=False)
+        for song in songs:
+            if song[0] in distributing or self.chain.distribute(song[0]).status:
+                self.server.new_song(song)
     
     def exit(self):
         if self.serving:
@@ -146,6 +202,7 @@ class User:
             self.server.close()
             self.server_handle.join()
             print('Server Closed')
+        self.chain.stop_indexer()
 
     def handler(self, signum, frame):
         # Close song
@@ -154,7 +211,7 @@ class User:
             return
         # Stop monitoring server
         if self.server is not None and self.server.debug:
-            self.server.debug = False
+            self.server.stop_monitor()
             return
         # Exit program
         self.exit()
@@ -165,16 +222,11 @@ def choose_song(songs):
     index = choose_option(list)
     return songs[index] if index is not None else None
 
-def choose_file(song_info, distributing):
-    songs = [] 
-    for x in glob.glob("downloads/*.mp3"):
-        with open(x, 'rb') as fd:
-            if fd.read(3) == MAGIC_BYTES:
-                id = os.path.basename(x).split('.')[0]
-                info = song_info(id)
-                if info and not distributing(id):
-                    name,auth,_ = info
-                    songs.append((id,name,auth))
+def choose_file(library):
+    # Songs of the library not served yet
+    songs = library.songs()
+    distributing = library.distributing(id for id,_,_ in songs)
+    songs = [s for s in songs if s[0] not in distributing]
     list = [f'\n\t({i+1}) {n} by {a}' for i,(_,n,a) in enumerate(songs)]
     index = choose_option(list)
     return songs[index] if index is not None else None
@@ -201,17 +253,35 @@ def amount_to_transfer():
     
 def valid_audio(filename):
     if filename and filename.split('.')[-1] == 'mp3':
-        with open(filename, 'rb') as fd:
-            if fd.read(3) == MAGIC_BYTES:
-                return filename
+        try:
+            with open(filename, 'rb') as fd:
+                if fd.read(3) == MAGIC_BYTES:
+                    return filename
+        except OSError as e:
+            print(f'\n{e}')
     print('\nInvalid file uploaded')
     return None
 
 
 if __name__ == '__main__':
-    user = User()
+    # Ingestion runs unattended, it fails instead of asking for a chain or an account
+    ingesting = len(sys.argv) > 2 and sys.argv[1] == 'ingest'
+    user = User(interactive=not ingesting)
     print(f'Welcome {user.name}!\n')
     print(f'Your chain address is {user.chain.account.address}')
+    if ingesting:
+        # python iotamss.py ingest <directory|manifest> [price] [--serve]
+        args = [arg for arg in sys.argv[2:] if arg != '--serve']
+        user.ingest(args[0], float(args[1]) if len(args) > 1 else None, '--serve' in sys.argv)
+        if user.serving:
+            user.server_handle.join()
+        exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        # python iotamss.py serve, distribute the whole library
+        user.serve_library()
+        if user.serving:
+            user.server_handle.join()
+        exit(0)
     while True:
         print(user.chain.get_balances())
         print("\nChoose an action:\n\t(l) Listen\n\t(d) Download\n\t(s) Serve\n\t(m) Monitor server\n\t(u) Upload\n\t(t) Transfer\n\t(e) Exit\n")
@@ -226,15 +296,16 @@ if __name__ == '__main__':
                 if song is not None:
                     user.download(song)
             case 's':
-                song = choose_file(user.chain.get_valid_song_info, user.chain.is_distributing)
+                song = choose_file(user.library)
                 if song is not None:
                     user.serve(song)
             case 'm':
                 if user.serving:
                     user.server.monitor()
-                    while user.server.debug:
-                        continue
+                    user.server.monitor_done.wait()
             case 'u':
+                # Only the interactive client needs a display
+                from tkinter import filedialog
                 file = valid_audio(filedialog.askopenfilename())
                 if file is not None:
                     user.upload(file)
@@ -0,0 +1,15 @@
+# Sets of chunk indices as hex strings, one bit per chunk
+
+def to_bitmap(indices):
+    return hex(sum(1 << i for i in indices))
+
+def from_bitmap(bitmap):
+    bits = int(bitmap, 16)
+    return {i for i in range(bits.bit_length()) if bits >> i & 1}
+
+def from_words(words, count):
+    # Paid chunks of a session as kept by the contract, 256 chunks per word
+    bits = 0
+    for i, word in enumerate(words):
+        bits |= word << (256 * i)
+    return {i for i in range(min(bits.bit_length(), count)) if bits >> i & 1}
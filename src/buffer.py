@@ -1,95 +1,133 @@
-import os
-import vlc
 import threading
+from collections import deque
+from src.sink import VlcSink
 
 class Buffer:
     # Default buffer size is approx. 2s - 4s ahead
-    def __init__(self, title, session, waiting_limit=5000):
-        # Start new temporary file
-        if not os.path.exists('tmp'):
-            os.makedirs('tmp')
-        self.fd = open('tmp/listening.mp3', 'wb')
-        self.fd.seek(0)
-        self.fd.truncate()
-        # Set VLC player
-        self.player = vlc.MediaPlayer()
-        self.media = vlc.Media(self.fd.name)
-        self.player.set_media(self.media)
+    # At most `window` chunks are paid for ahead of the buffered audio
+    def __init__(self, title, session, waiting_limit=5000, window=3, sink=VlcSink):
+        # Audio is played by a new sink on every start
+        self.sink_factory = sink
+        self.sink = None
+        # Wake up waiting loops on player events instead of polling
+        self.cond = threading.Condition()
+        self.version = 0
+        session.close_callbacks.append(self.notify)
         # Initialize state
         self.title = title
         self.session = session
         self.waiting_limit = waiting_limit
+        self.window = window
         self.loaded = 0
-        self.last_stop_load = 0
-        self.last_pos = 0
+        self.added = 0
         self.running = False
-        
+        self.ended = False
+
     def start(self):
+        self.sink = self.sink_factory(self.session)
+        self.sink.on_event(self.on_event)
+        self.loaded = 0
+        self.added = 0
+        self.ended = False
         self.running = True
         self.handle = threading.Thread(target=self.run)
         self.handle.start()
 
+    def notify(self, *args):
+        # Never call the player while holding the condition, player events
+        # are delivered from its own thread
+        with self.cond:
+            self.version += 1
+            self.cond.notify_all()
+
+    def wait_change(self, version, timeout=None):
+        with self.cond:
+            self.cond.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    def on_event(self, ended):
+        if ended:
+            self.ended = True
+        self.notify()
+
     def add_chunk(self, chunk):
-        # Append chunk to temp file
-        self.fd.write(chunk)
-        self.fd.flush()
+        # Hand chunk to the player
+        self.sink.write(chunk)
         self.loaded += len(chunk)
+        self.added += 1
+        if self.loaded >= self.session.length:
+            self.sink.finish()
 
-        if not self.player.is_playing():
-            if self.get_time_left() > self.waiting_limit:
-                self.player.play()
+        if not self.sink.is_playing():
+            if self.get_time_left() > self.waiting_limit or self.loaded >= self.session.length:
+                self.sink.play()
+        self.notify()
 
     def get_time_left(self):
-        pos = 0 if self.loaded == 0 else self.player.get_position() * self.last_stop_load / self.loaded
-        if pos > 0:
-            # Approx from player time and position
-            return self.player.get_time() / pos * (1-pos) 
-        else: 
+        # Exact when chunks are cut on MP3 frames, the next chunk starts where loaded audio ends
+        loaded_time = self.session.chunk_time(self.added)
+        if loaded_time is None:
             # Approx from percentage loaded of duration
-            return self.session.duration * 1000 * (self.loaded/self.session.length)
+            loaded_time = self.session.duration * 1000 * (self.loaded/self.session.length)
+        return loaded_time - self.sink.get_time()
 
     def prudent_loading(self):
-        i, past_time  = 0, -1
-        while i < self.session.chunks_len and self.session.active:
-            try:
-                # TODO: Get chunks synchronously
-                t = self.get_time_left()
-                if t != past_time and t < self.waiting_limit:
-                    past_time = t
-                    self.add_chunk(self.session.get_chunk(i))
+        # Chunks being paid for, in order
+        payments = deque()
+        i = 0
+        version = self.version
+        try:
+            while self.added < self.session.chunks_len and self.session.active:
+                in_flight = len(payments) + len(self.session.pending)
+                # Pay ahead only while buffered audio is running low
+                if i < self.session.chunks_len and in_flight < self.window and self.get_time_left() < self.waiting_limit:
+                    payments.append((i, self.session.pay_chunk_async(i)))
                     i += 1
-            except Exception as e:
-                self.close()
-                raise e
+                # Request each chunk as soon as it is paid
+                elif payments and (payments[0][1] is None or payments[0][1].done() or not self.session.pending):
+                    self.session.send_paid_request(*payments.popleft())
+                # Hand verified chunks to the player in order
+                elif self.session.pending:
+                    self.add_chunk(self.session.verified_response())
+                # Enough audio is buffered, sleep until the player moves
+                else:
+                    version = self.wait_change(version, 1)
+        except Exception as e:
+            self.session.disconnect()
+            self.close()
+            raise e
+
+    def wait(self):
+        # Block until the song ends or the session is closed
+        version = self.version
+        while self.running and self.session.active:
+            version = self.wait_change(version)
 
     def close(self):
         if self.running:
             self.running = False
+            self.notify()
             self.handle.join()
             print()
 
     def get_progress(self):
-        vlc_loaded = self.loaded if self.player.is_playing() else self.last_stop_load
-        return  vlc_loaded * self.player.get_position()  / self.session.length
+        return self.sink.get_time() / (self.session.duration * 1000)
 
     def print_state(self):
-        state = '_ ' if self.player.is_playing() else 'p '
+        state = '_ ' if self.sink.is_playing() else 'p '
         print(f"{state} {'{:.01%}'.format(self.get_progress())} {'{:.01%}'.format(self.loaded/self.session.length)} - {self.title}{' '*9}", end='\r')
 
     def run(self):
         print()
-        while self.get_progress() < 0.99 and self.running:
+        version = self.version
+        while self.running and not self.ended:
             self.print_state()
-            # Update load state
-            if self.player.is_playing():
-                self.last_stop_load = self.loaded
-            pos = self.player.get_position()
-            if self.last_pos != pos:
-                # Pause and wait for next chunk
-                if self.get_time_left() < self.waiting_limit//2 and self.loaded != self.session.length:
-                    self.player.pause()
-                self.last_pos = pos
+            # Pause and wait for next chunk
+            if self.sink.is_playing() and self.get_time_left() < self.waiting_limit//2 and self.loaded != self.session.length:
+                self.sink.pause()
+            version = self.wait_change(version, 1)
         # Close buffer
-        self.player.stop()
+        self.sink.stop()
         self.running = False
-        print()
\ No newline at end of file
+        self.notify()
+        print()
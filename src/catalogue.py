@@ -0,0 +1,73 @@
+import os
+import time
+import sqlite3
+DB_FILE = "tmp/catalogue.db"
+# Amount of songs read per call
+PAGE_LEN = 100
+# Seconds before validity and prices of known songs are read again
+REFRESH_INTERVAL = 60
+
+class Catalogue:
+    def __init__(self, chain, filename=DB_FILE):
+        self.chain = chain
+        if not os.path.exists(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        self.db = sqlite3.connect(filename)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS songs (
+                position INTEGER PRIMARY KEY,
+                id TEXT NOT NULL,
+                valid INTEGER NOT NULL,
+                author TEXT NOT NULL,
+                name TEXT NOT NULL,
+                price TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS authors (address TEXT PRIMARY KEY, name TEXT NOT NULL);
+        """)
+        # Index is only valid for the contract it was built from
+        if self.get_meta('contract') != chain.contract.address:
+            with self.db:
+                self.db.execute('DELETE FROM songs')
+                self.db.execute('DELETE FROM authors')
+                self.set_meta('contract', chain.contract.address)
+                self.set_meta('refreshed', 0)
+
+    def get_meta(self, key):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, str(value)))
+
+    def sync(self):
+        count = self.chain.get_song_count()
+        known = self.db.execute('SELECT COUNT(*) FROM songs').fetchone()[0]
+        # Known songs are only refreshed from time to time
+        start = known
+        if time.time() - float(self.get_meta('refreshed')) > REFRESH_INTERVAL:
+            start = 0
+        with self.db:
+            for i in range(start, count, PAGE_LEN):
+                self.store(i, self.chain.get_song_page(i, PAGE_LEN))
+            if start == 0:
+                self.set_meta('refreshed', time.time())
+
+    def store(self, start, page):
+        rows = [(start+i, id, int(valid), auth, name, str(p)) for i,(id,valid,auth,name,p) in enumerate(page)]
+        # Only rows whose validity or price changed are written
+        self.db.executemany("""
+            INSERT INTO songs VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(position) DO UPDATE SET valid = excluded.valid, price = excluded.price
+            WHERE valid != excluded.valid OR price != excluded.price
+        """, rows)
+        # Each author's name is read once
+        for auth in {r[3] for r in rows}:
+            if self.db.execute('SELECT 1 FROM authors WHERE address = ?', (auth,)).fetchone() is None:
+                self.db.execute('INSERT INTO authors VALUES (?, ?)', (auth, self.chain.get_user_info(auth)[1]))
+
+    def list(self, address):
+        return [(id, name, auth, int(p)) for id,name,auth,p in self.db.execute("""
+            SELECT s.id, s.name, a.name, s.price FROM songs s JOIN authors a ON s.author = a.address
+            WHERE s.valid OR s.author = ? ORDER BY s.position
+        """, (address,))]
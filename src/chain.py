@@ -1,7 +1,21 @@
 import json
 import base64
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from web3 import Web3
 from eth_account.messages import encode_defunct
+from src.bitmap import from_words
+from src.catalogue import Catalogue
+from src.indexer import Indexer
+from src.metrics import metrics
+from src.viewcache import ViewCache
+# Amount of chunk hashes read per call
+HASH_PAGE_LEN = 500
+# Songs checked at once for a distributor
+DISTRIBUTING_PAGE_LEN = 500
+# Seconds a sync of the index may be old when a payment is not found in it
+PAID_SYNC_AGE = 0.1
+CONFIG_FILE = "config.json"
 
 def wei_to_miota(wei):
     return wei / 1e18
@@ -16,16 +30,73 @@ def fix_price(p, chunks):
     # price divisible by chunks length and chunk price divivisble by distributor fee (10%)
     return p - (p % (chunks * 10))
 
+class TxManager:
+    def __init__(self, w3, account, workers=8, on_receipt=None):
+        self.w3 = w3
+        self.account = account
+        # Called with the function name of every transaction mined, before its receipt is returned
+        self.on_receipt = on_receipt
+        self.chain_id = w3.eth.chain_id
+        self.lock = threading.Lock()
+        self.sync()
+        # Receipts are awaited in the background
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='receipts')
+
+    def sync(self):
+        self.nonce = self.w3.eth.get_transaction_count(self.account.address, 'pending')
+
+    def submit(self, fn, gas, value):
+        metrics.count(f'tx.{fn.fn_name}')
+        with self.lock, metrics.timer('tx.sign_and_send'):
+            params = {
+                "nonce": self.nonce,
+                "gas": gas,
+                "chainId": self.chain_id,
+                "gasPrice": iota_to_wei(1)
+            }
+            if value:
+                params["value"] = value
+            try:
+                tx_hash = self.send(fn, params)
+            except ValueError:
+                # Local nonce is out of sync, e.g. a transaction was dropped
+                self.sync()
+                params["nonce"] = self.nonce
+                tx_hash = self.send(fn, params)
+            self.nonce += 1
+        return self.pool.submit(self.wait_receipt, tx_hash, fn.fn_name)
+
+    def wait_receipt(self, tx_hash, fn_name):
+        with metrics.timer('tx.receipt'):
+            receipt = self.w3.eth.wait_for_transaction_receipt(tx_hash)
+        if self.on_receipt is not None:
+            self.on_receipt(fn_name)
+        return receipt
+
+    def send(self, fn, params):
+        signed_tx = self.w3.eth.account.sign_transaction(fn.build_transaction(params), self.account.key)
+        return self.w3.eth.send_raw_transaction(signed_tx.rawTransaction)
+
 class Chain:
-    def __init__(self):
+    def __init__(self, config_file=CONFIG_FILE, interactive=True):
+        self.config_file = config_file
+        self.catalogue = None
+        self.indexer = None
         # Connect to chain
         try:
             self.get_chain_info()
         except:
+            if not interactive:
+                raise
             print('You are not connected to any chain')
             self.set_chain_info()
         print(f'\nConnected to chain\n')
+        # Answers of the contract, until a new block or one of our transactions
+        self.cache = ViewCache(self.w3)
+        self.txs = TxManager(self.w3, self.account, on_receipt=self.cache.invalidate)
         # Create account in the contract
+        if not interactive and not self.get_user_info()[0]:
+            raise Exception(f'No account in the contract for {self.account.address}')
         while not self.get_user_info()[0]:
             print(f'Deposit to your chain wallet: {self.account.address}')
             print(self.get_balances())
@@ -37,7 +108,7 @@ class Chain:
                     print(f'\n{e}')
     
     def get_chain_info(self):
-        with open('config.json', 'r') as f:
+        with open(self.config_file, 'r') as f:
             config = json.load(f)
             # Connect to the local Ethereum node
             self.w3 = Web3(Web3.HTTPProvider(config["url"]))
@@ -55,7 +126,7 @@ class Chain:
         # Generate wallet account
         self.account = self.w3.eth.account.create()
         # Save user in config file
-        with open('config.json', 'w') as f:
+        with open(self.config_file, 'w') as f:
             f.write(json.dumps({
                 "url": provider,
                 "contract": self.contract.address,
@@ -69,57 +140,43 @@ class Chain:
     def get_user_info(self, address=None):
         if address is None:
             address = self.account.address
-        return self.contract.functions.users(address).call()
+        return self.view('users', address)
 
     def create_contract_account(self):
         name = input('\nName: ')
         desc = input('Description: ')
-        tx = self.contract.functions.create_user(name, desc).build_transaction({
-            "nonce": self.w3.eth.get_transaction_count(self.account.address),
-            "gas": iota_to_wei(1),
-            "chainId": self.w3.eth.chain_id,
-            "gasPrice": iota_to_wei(1),
-        })
-        return self.sign_and_send(tx)
+        tx = self.contract.functions.create_user(name, desc)
+        return self.transact(tx)
 
     def deposit(self, amount):
-        tx = self.contract.functions.deposit().build_transaction({
-            "nonce": self.w3.eth.get_transaction_count(self.account.address),
-            "gas": 3000000,
-            "chainId": self.w3.eth.chain_id,
-            "gasPrice": iota_to_wei(1),
-            "value": miota_to_wei(amount)
-        })
-        return self.sign_and_send(tx)
+        tx = self.contract.functions.deposit()
+        return self.transact(tx, gas=3000000, value=miota_to_wei(amount))
 
     def upload(self, song):
-        tx = self.contract.functions.upload_song(
-            song.name,
-            fix_price(miota_to_wei(song.price), len(song.chunks)),
-            song.length,
-            int(song.duration),
-            song.chunks
-        ).build_transaction({
-            "nonce": self.w3.eth.get_transaction_count(self.account.address),
-            "gas": iota_to_wei(1),
-            "chainId": self.w3.eth.chain_id,
-            "gasPrice": iota_to_wei(1)
-        })
-        if not self.sign_and_send(tx).status:
+        if not self.upload_async(song).result().status:
             return None
         return self.gen_song_id(song.name)
 
+    def upload_async(self, song):
+        price = fix_price(miota_to_wei(song.price), len(song.chunks))
+        if song.root is not None:
+            # Only the root of the chunk hashes is stored on chain
+            tx = self.contract.functions.upload_song_merkle(
+                song.name, price, song.length, int(song.duration), song.root, len(song.chunks))
+        else:
+            tx = self.contract.functions.upload_song(
+                song.name, price, song.length, int(song.duration), song.chunks)
+        return self.send(tx)
+
     def gen_song_id(self, name):
-        return '0x'+self.contract.functions.gen_song_id(name, self.account.address).call().hex()
+        return '0x'+self.view_immutable('gen_song_id', name, self.account.address).hex()
 
     def distribute(self, id):
-        tx = self.contract.functions.distribute(id).build_transaction({
-            "nonce": self.w3.eth.get_transaction_count(self.account.address),
-            "gas": iota_to_wei(1),
-            "chainId": self.w3.eth.chain_id,
-            "gasPrice": iota_to_wei(1)
-        })
-        return self.sign_and_send(tx)
+        return self.distribute_async(id).result()
+
+    def distribute_async(self, id):
+        tx = self.contract.functions.distribute(id)
+        return self.send(tx)
 
     def undistribute_all(self, ids):
         print('\n')
@@ -128,108 +185,167 @@ class Chain:
                 print(f'Stopped serving {id}')
 
     def undistribute(self, id):
-        tx = self.contract.functions.undistribute(id).build_transaction({
-            "nonce": self.w3.eth.get_transaction_count(self.account.address),
-            "gas": iota_to_wei(1),
-            "chainId": self.w3.eth.chain_id,
-            "gasPrice": iota_to_wei(1)
-        })
-        return self.sign_and_send(tx)
+        tx = self.contract.functions.undistribute(id)
+        return self.transact(tx)
 
     def edit_url(self, url):
-        tx = self.contract.functions.edit_url(url).build_transaction({
-            "nonce": self.w3.eth.get_transaction_count(self.account.address),
-            "gas": iota_to_wei(1),
-            "chainId": self.w3.eth.chain_id,
-            "gasPrice": iota_to_wei(1)
-        })
-        return self.sign_and_send(tx)
+        tx = self.contract.functions.edit_url(url)
+        return self.transact(tx)
 
     def get_song_list(self):
-        i, lst = 0, []
-        while True:
-            try:
-                id = '0x'+self.contract.functions.song_list(i).call().hex()
-                info = self.get_valid_song_info(id)
-                if info is not None:
-                    name,auth,p = info
-                    lst.append((id,name,auth,wei_to_miota(p)))
-                i += 1
-            except:
-                break
-        return lst
+        # Song list is kept in a local index synced from the contract
+        if self.catalogue is None:
+            self.catalogue = Catalogue(self)
+        self.catalogue.sync()
+        return [(id,name,auth,wei_to_miota(p)) for id,name,auth,p in self.catalogue.list(self.account.address)]
+
+    def get_song_count(self):
+        return self.view('song_count')
+
+    def get_song_page(self, start, count):
+        ids,valid,authors,names,prices = self.view('song_page', start, count)
+        return [('0x'+id.hex(),v,a,n,p) for id,v,a,n,p in zip(ids,valid,authors,names,prices)]
 
     def get_valid_song_info(self, id):
-        _,valid,addr,name,p,_,_ = self.contract.functions.songs(id).call()
+        _,valid,addr,name,p,_,_,_,_ = self.view('songs', id)
         if valid or addr == self.account.address:
-            _,auth,_,_,_,_ = self.contract.functions.users(addr).call()
+            _,auth,_,_,_,_ = self.view('users', addr)
             price = self.get_real_price(p)
             return name,auth,price
         return None
 
     def get_real_price(self, p):
-        return p + self.contract.functions.compute_distributor_fee(p).call()
+        return p + self.view_immutable('compute_distributor_fee', p)
 
     def get_song_metadata(self, id):
-        _,_,_,_,_,length,duration = self.contract.functions.songs(id).call()
-        chunk_len = self.contract.functions.chunks_length(id).call()
-        return length, duration, chunk_len
+        length, duration, _, chunks_len = self.get_song_constants(id)
+        return length, duration, chunks_len
     
-    def is_distributing(self, id, address=None):
+    def get_merkle_root(self, id):
+        # None for songs storing every chunk hash
+        root = self.get_song_constants(id)[2]
+        return root if any(root) else None
+
+    def get_song_constants(self, id):
+        # Length, duration, root and chunk count are set at upload and never change
+        def read():
+            exists,_,_,_,_,length,duration,root,chunks_len = self.view('songs', id)
+            return exists, (length, duration, root, chunks_len)
+        return self.cache.get_immutable(('songs', id), read, lambda song: song[0])[1]
+
+    def is_distributing(self, id, address=None, indexed=True):
         if address is None:
             address = self.account.address
-        return self.contract.functions.is_distributing(id, address).call()
+        if indexed and address == self.account.address and self.indexer is not None:
+            distributing = self.indexer.is_distributing(id)
+            if distributing is not None:
+                return distributing
+        return self.view('is_distributing', id, address)
+
+    def get_distributing(self, ids, address=None, indexed=True):
+        # Whether we distribute each song, songs the index does not know are read
+        # from the contract a page at a time
+        if address is None:
+            address = self.account.address
+        ids = list(ids)
+        known = {}
+        if indexed and address == self.account.address and self.indexer is not None:
+            known = {id: self.indexer.is_distributing(id) for id in ids}
+        unknown = [id for id in ids if known.get(id) is None]
+        for i in range(0, len(unknown), DISTRIBUTING_PAGE_LEN):
+            page = unknown[i:i+DISTRIBUTING_PAGE_LEN]
+            known.update(zip(page, self.call('distributing_page', page, address)))
+        return [known[id] for id in ids]
 
     def create_session(self, song_id, distributor=None):
         if distributor is None:
             distributor = self.get_rand_distributor(song_id)
-        tx = self.contract.functions.create_session(song_id, distributor).build_transaction({
-            "nonce": self.w3.eth.get_transaction_count(self.account.address),
-            "gas": iota_to_wei(1),
-            "chainId": self.w3.eth.chain_id,
-            "gasPrice": iota_to_wei(1)
-        })
-        if not self.sign_and_send(tx).status:
+        tx = self.contract.functions.create_session(song_id, distributor)
+        if not self.transact(tx).status:
             return None, distributor
         return self.gen_session_id(self.account.address, distributor, song_id), distributor
 
+    def is_session_open(self, id):
+        # Session is still active and we are its listener
+        active,addr,_,_,_,_ = self.get_session_info(id)
+        return active and addr == self.account.address
+
     def get_rand_distributor(self, id):
-        return self.contract.functions.get_rand_distributor(id).call()
+        return self.view('get_rand_distributor', id)
+
+    def get_distributors(self, id):
+        # First entry of the list is a placeholder
+        return self.view('get_distributors', id)[1:]
         
     def gen_session_id(self, sender, distributor, song_id):
-        return '0x'+self.contract.functions.gen_session_id(sender, distributor, song_id).call().hex()
+        return '0x'+self.view_immutable('gen_session_id', sender, distributor, song_id).hex()
 
     def get_chunk(self, id, index):
-        tx = self.contract.functions.get_chunk(id, index).build_transaction({
-            "nonce": self.w3.eth.get_transaction_count(self.account.address),
-            "gas": iota_to_wei(1),
-            "chainId": self.w3.eth.chain_id,
-            "gasPrice": iota_to_wei(1)
-        })
-        return self.sign_and_send(tx)
+        tx = self.contract.functions.get_chunk(id, index)
+        return self.transact(tx)
+
+    def get_chunk_async(self, id, index):
+        tx = self.contract.functions.get_chunk(id, index)
+        return self.send(tx)
 
     def check_chunk(self, id, index, chunk):
 
-        return self.contract.functions.check_chunk(id, index, chunk).call()
+        return self.view('check_chunk', id, index, chunk)
+
+    def get_chunk_hashes(self, id):
+        def read():
+            # Read the whole hash array in pages
+            chunks_len = self.get_song_metadata(id)[2]
+            hashes = []
+            while len(hashes) < chunks_len:
+                page = self.view('chunk_hashes', id, len(hashes), HASH_PAGE_LEN)
+                if not page:
+                    break
+                hashes += ['0x'+h.hex() for h in page]
+            return hashes
+        return self.cache.get_immutable(('chunk_hashes', id), read, lambda hashes: len(hashes) > 0)
     
-    def is_chunk_paid(self, id, index):
-        return self.contract.functions.is_chunk_paid(id, index).call()
+    def start_indexer(self):
+        # Follow the contract's events to answer session and payment checks locally
+        if self.indexer is None:
+            self.indexer = Indexer(self)
+            self.indexer.start()
+        return self.indexer
+
+    def stop_indexer(self):
+        # Keep what the index read for the next start
+        if self.indexer is not None:
+            self.indexer.stop()
+            self.indexer = None
+
+    def get_paid_chunks(self, id, chunks_len, index=None):
+        # Chunks paid in a session, read up to the latest block when index is not among them,
+        # and from the contract itself if the index is still behind
+        if self.indexer is not None:
+            session = self.indexer.get_session(id)
+            if session is not None and (index is None or index in session[6]):
+                return set(session[6])
+            # Payment may be in a block the index has not read yet
+            self.indexer.sync(PAID_SYNC_AGE)
+            session = self.indexer.get_session(id)
+            if session is not None and (index is None or index in session[6]):
+                return set(session[6])
+        return from_words(self.view('paid_bitmap', id), chunks_len)
     
     def get_session_info(self, id):
-        active,addr,dist,song_id,p,b = self.contract.functions.sessions(id).call()
+        session = self.indexer.get_session(id) if self.indexer is not None else None
+        if session is not None:
+            active,addr,dist,song_id,p,b,_ = session
+            return active,addr,dist,song_id,wei_to_miota(p),wei_to_miota(b)
+        active,addr,dist,song_id,p,b = self.view('sessions', id)
         return active,addr,dist,'0x'+song_id.hex(),wei_to_miota(p),wei_to_miota(b)
 
     def close_session(self, id):
-        tx = self.contract.functions.close_session(id).build_transaction({
-            "nonce": self.w3.eth.get_transaction_count(self.account.address),
-            "gas": iota_to_wei(1),
-            "chainId": self.w3.eth.chain_id,
-            "gasPrice": iota_to_wei(1)
-        })
-        return self.sign_and_send(tx)
+        tx = self.contract.functions.close_session(id)
+        return self.transact(tx)
 
     def get_balances(self):
-        chain = wei_to_miota(self.w3.eth.get_balance(self.account.address))
+        chain = wei_to_miota(self.cache.get(('balance',), lambda: self.w3.eth.get_balance(self.account.address)))
         try:
             contract = self.get_contract_balance()
         except:
@@ -245,7 +361,20 @@ class Chain:
     def get_contract_balance(self):
         return wei_to_miota(self.get_user_info()[4])
 
-    def sign_and_send(self, tx):
-        signed_tx = self.w3.eth.account.sign_transaction(tx, self.account.key)
-        tx_hash = self.w3.eth.send_raw_transaction(signed_tx.rawTransaction)
-        return self.w3.eth.wait_for_transaction_receipt(tx_hash)
\ No newline at end of file
+    def view(self, name, *args):
+        # Every read of the contract goes through here to be cached, counted and timed
+        return self.cache.get((name,) + args, lambda: self.call(name, *args))
+
+    def view_immutable(self, name, *args):
+        return self.cache.get_immutable((name,) + args, lambda: self.call(name, *args))
+
+    def call(self, name, *args):
+        with metrics.timer(f'call.{name}'):
+            return getattr(self.contract.functions, name)(*args).call()
+
+    def send(self, tx, gas=iota_to_wei(1), value=0):
+        # Submit without waiting, returns a future of the receipt
+        return self.txs.submit(tx, gas, value)
+
+    def transact(self, tx, gas=iota_to_wei(1), value=0):
+        return self.send(tx, gas, value).result()
\ No newline at end of file
@@ -0,0 +1,264 @@
+import os
+import json
+import time
+import random
+import threading
+from collections import deque
+from src.session import Session, PIPELINE_DEPTH
+from src.mp3 import pack_index
+from src.bitmap import to_bitmap, from_bitmap
+from src.metrics import metrics
+# Maximum amount of distributors a song is downloaded from at once
+MAX_PEERS = 3
+# Seconds a distributor may take to answer before its chunks are reassigned
+PEER_TIMEOUT = 30
+# Seconds between journal writes, chunks written since are fetched again after a crash
+JOURNAL_INTERVAL = 1
+
+class Journal:
+    def __init__(self, filename):
+        self.filename = filename
+        self.length = None
+        self.verified = set()
+        # Bytes written, chunks are written in order
+        self.offset = 0
+        # Distributor of every session opened for the download
+        self.sessions = {}
+        if os.path.exists(filename):
+            try:
+                with open(filename, 'r') as f:
+                    state = json.load(f)
+                self.length = state['length']
+                self.verified = from_bitmap(state['verified'])
+                self.offset = state['offset']
+                self.sessions = state['sessions']
+            except (ValueError, KeyError):
+                self.length = None
+
+    def reset(self, length):
+        self.length = length
+        self.verified = set()
+        self.offset = 0
+        self.sessions = {}
+
+    def save(self, sessions):
+        for session in sessions:
+            if session.on_chain:
+                self.sessions[session.id] = session.dist
+            else:
+                self.sessions.pop(session.id, None)
+        # Replace journal at once so it is never left half written
+        with open(self.filename + '.tmp', 'w') as f:
+            json.dump({
+                "length": self.length,
+                "verified": to_bitmap(self.verified),
+                "offset": self.offset,
+                "sessions": self.sessions
+            }, f)
+        os.replace(self.filename + '.tmp', self.filename)
+
+    def remove(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+class Download:
+    def __init__(self, chain, song, chunk_len, max_peers=MAX_PEERS, health=None):
+        self.chain = chain
+        self.health = health
+        self.song = song
+        self.chunk_len = chunk_len
+        self.max_peers = max_peers
+        self.active = True
+        self.sessions = []
+        # Sessions of earlier attempts still open on chain
+        self.idle = []
+        self.journal = None
+        self.saved = 0
+        self.missing = set()
+        # Verified chunks waiting for the ones before them to be written
+        self.received = {}
+        self.queue = deque()
+        self.lock = threading.Lock()
+        # Idle workers wait here for chunks handed back by a failing distributor
+        self.cond = threading.Condition(self.lock)
+        # Batches taken by workers and not finished yet
+        self.in_flight = 0
+        # Chunks paid to distributors that failed before sending them
+        self.stranded = set()
+        self.repaid = 0
+
+    def open_sessions(self):
+        # Session ids include the distributor, so one session per distributor
+        dists = self.chain.get_distributors(self.song[0])
+        if self.health is not None and dists:
+            # Fastest distributors first, by latency, throughput and failures seen
+            dists = self.health.select(self.chain, dists, self.chunk_len, len(dists))
+        else:
+            random.shuffle(dists)
+        # Prefer distributors of sessions left open by an earlier attempt
+        opened = {d: id for id,d in self.journal.sessions.items()}
+        dists.sort(key=lambda d: d not in opened)
+        error = Exception('Song is not being distributed')
+        for dist in dists[:self.max_peers]:
+            # The new session takes over the one of the earlier attempt
+            if dist in opened:
+                self.idle = [s for s in self.idle if s.id != opened[dist]]
+            session = Session(self.chain, self.chunk_len, PEER_TIMEOUT, self.health)
+            try:
+                if dist in opened and self.chain.is_session_open(opened[dist]):
+                    session.resume(self.song, opened[dist], dist)
+                else:
+                    session.create(self.song, dist)
+                self.sessions.append(session)
+            except Exception as e:
+                error = e
+                if session.on_chain:
+                    session.close_on_chain()
+                # Every session locks the song's price in the contract
+                if str(e).startswith('\nInsufficient'):
+                    break
+        if not self.sessions:
+            raise error
+
+    def run(self, filename):
+        # Chunks are written to a partial file and recorded in a journal
+        part = f'{filename}.part'
+        if self.journal is None:
+            self.journal = Journal(f'{filename}.journal')
+        self.open_sessions()
+        first = self.sessions[0]
+        written = len(self.journal.verified)
+        if self.journal.length != first.length or not os.path.exists(part) \
+                or self.journal.verified != set(range(written)):
+            # Preallocate file, chunks are written in order as they arrive
+            with open(part, 'wb') as fd:
+                fd.truncate(first.length)
+            self.journal.reset(first.length)
+        self.journal.save(self.sessions)
+        # Only fetch chunks not verified yet
+        self.missing = set(range(first.chunks_len)) - self.journal.verified
+        self.received = {}
+        self.stranded = set()
+        self.queue = deque(sorted(self.missing))
+        self.in_flight = 0
+        with open(part, 'r+b') as fd:
+            workers = [threading.Thread(target=self.work, args=(s, fd)) for s in self.sessions]
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+        if self.repaid:
+            print(f'\n{self.repaid} chunks paid again after their distributor failed')
+        if self.missing:
+            self.journal.save(self.sessions)
+            raise Exception(f'Download incomplete: {len(self.missing)} chunks missing')
+        os.replace(part, filename)
+        self.journal.remove()
+        # Keep the chunk layout to distribute the song later
+        index = next((s.index for s in self.sessions if s.index), None)
+        if index:
+            with open(os.path.splitext(filename)[0] + '.idx', 'wb') as fd:
+                fd.write(pack_index(index))
+
+    def work(self, session, fd):
+        # Each distributor takes the next missing chunks until none are left
+        while session.active:
+            batch = self.take(session)
+            if not batch:
+                return
+            try:
+                for chunk in session.get_chunks(list(batch)):
+                    index = batch.popleft()
+                    self.write(fd, index, chunk)
+            except Exception as e:
+                if self.active:
+                    print(f'\nDistributor {session.dist_name} failed: {e}')
+                self.release(batch, set(session.paid_chunks))
+                session.close()
+                return
+            self.release(batch)
+
+    def take(self, session):
+        with self.cond:
+            # Queue may be refilled while other distributors still hold batches
+            while not self.queue and self.in_flight and session.active and self.active:
+                self.cond.wait(1)
+            if not session.active or not self.active:
+                return deque()
+            # Chunks already paid in this session come first
+            batch = [i for i in self.queue if i in session.paid_chunks][:PIPELINE_DEPTH]
+            for i in batch:
+                self.queue.remove(i)
+            while len(batch) < PIPELINE_DEPTH and self.queue:
+                batch.append(self.queue.popleft())
+            repaid = sum(i in self.stranded and i not in session.paid_chunks for i in batch)
+            if repaid:
+                self.repaid += repaid
+                metrics.count('download.repaid', repaid)
+            self.stranded.difference_update(batch)
+            if batch:
+                self.in_flight += 1
+        return deque(batch)
+
+    def release(self, batch, paid=frozenset()):
+        # Hand unfinished chunks to the remaining distributors, the ones paid to a
+        # failing distributor last since resuming its session gets them for free
+        with self.cond:
+            self.queue.extendleft(reversed([i for i in batch if i not in paid]))
+            self.queue.extend(i for i in batch if i in paid)
+            self.stranded.update(i for i in batch if i in paid)
+            self.in_flight -= 1
+            self.cond.notify_all()
+
+    def write(self, fd, index, chunk):
+        # Chunks are only verified by their hash, so each one is written right after
+        # the previous one instead of at an offset given by a distributor
+        with self.lock:
+            self.received[index] = chunk
+            written = len(self.journal.verified)
+            while written in self.received:
+                chunk = self.received.pop(written)
+                fd.seek(self.journal.offset)
+                fd.write(chunk)
+                self.journal.offset += len(chunk)
+                self.missing.discard(written)
+                self.journal.verified.add(written)
+                written += 1
+            fd.flush()
+            if time.monotonic() - self.saved >= JOURNAL_INTERVAL:
+                self.journal.save(self.sessions)
+                self.saved = time.monotonic()
+            done = 1 - len(self.missing) / self.sessions[0].chunks_len
+        _, name, auth, _ = self.song
+        peers = sum(s.active for s in self.sessions)
+        print(f"{name} by {auth}: {'{:.01%}'.format(done)} ({peers} distributors)", end='\r')
+
+    def disconnect_sessions(self):
+        # Sessions stay open on chain and in the journal for the next run to resume
+        for session in self.sessions:
+            if session.active:
+                session.close()
+        if self.journal is not None and os.path.exists(self.journal.filename):
+            self.journal.save(self.sessions)
+        self.idle += [s for s in self.sessions if s.on_chain]
+        self.sessions = []
+
+    def close_sessions(self):
+        sessions = self.sessions + self.idle
+        for session in sessions:
+            if session.active:
+                session.close()
+            if session.on_chain:
+                session.close_on_chain()
+        # Closed sessions can not be resumed
+        if self.journal is not None and os.path.exists(self.journal.filename):
+            self.journal.save(sessions)
+        self.sessions = []
+        self.idle = []
+        # Sessions of a download run at once and share the metrics, dumped together
+        metrics.dump(f'tmp/metrics/{self.song[0]}.json', reset=True)
+
+    def close(self):
+        self.active = False
+        for session in self.sessions:
+            session.close()
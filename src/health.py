@@ -0,0 +1,104 @@
+import os
+import json
+import time
+import socket
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from src.protocol import send_frame, recv_frame
+from src.session import get_tls_state, parse_server_url
+HEALTH_FILE = "tmp/health.json"
+# Weight of the newest sample in every moving average
+ALPHA = 0.3
+# Most distributors probed before choosing one
+MAX_PROBES = 6
+# Seconds a probe may take before the distributor is considered down
+PROBE_TIMEOUT = 2
+
+def probe(url, timeout=PROBE_TIMEOUT):
+    # Time a handshake and a PING round trip to a distributor's server
+    address, cert = parse_server_url(url)
+    tls = get_tls_state(address, cert)
+    start = time.monotonic()
+    with socket.create_connection(address, timeout) as sock:
+        with tls.context.wrap_socket(sock, session=tls.session) as conn:
+            send_frame(conn, b'PING')
+            if recv_frame(conn) != b'PONG':
+                raise ConnectionError('unexpected answer to PING')
+            tls.session = conn.session
+    return time.monotonic() - start
+
+class HealthCache:
+    # Moving averages of latency, throughput and failure rate of every distributor
+    def __init__(self, filename=HEALTH_FILE):
+        self.filename = filename
+        self.entries = {}
+        self.lock = threading.Lock()
+        if os.path.exists(filename):
+            try:
+                with open(filename, 'r') as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                self.entries = {}
+
+    def save(self):
+        if not os.path.exists(os.path.dirname(self.filename)):
+            os.makedirs(os.path.dirname(self.filename))
+        with self.lock:
+            entries = json.dumps(self.entries)
+        with open(self.filename + '.tmp', 'w') as f:
+            f.write(entries)
+        os.replace(self.filename + '.tmp', self.filename)
+
+    def update(self, dist, key, value):
+        with self.lock:
+            entry = self.entries.setdefault(dist, {"latency": None, "throughput": None, "failure": 0.0})
+            old = entry[key]
+            entry[key] = value if old is None else (1 - ALPHA) * old + ALPHA * value
+
+    def record_probe(self, dist, latency):
+        self.update(dist, 'latency', latency)
+        self.update(dist, 'failure', 0.0)
+
+    def record_transfer(self, dist, size, seconds):
+        if seconds > 0:
+            self.update(dist, 'throughput', size / seconds)
+
+    def record_failure(self, dist):
+        self.update(dist, 'failure', 1.0)
+
+    def score(self, dist, chunk_len):
+        # Expected seconds to get a chunk, higher for distributors that fail often
+        entry = self.entries.get(dist)
+        if entry is None or entry['latency'] is None:
+            return None
+        seconds = entry['latency']
+        if entry['throughput']:
+            seconds += chunk_len / entry['throughput']
+        return seconds / max(1 - entry['failure'], 0.05)
+
+    def select(self, chain, dists, chunk_len, count=1):
+        # Probe the best known distributors along with some never tried before,
+        # and return the best ones first
+        scores = {d: self.score(d, chunk_len) for d in dists}
+        known = sorted((d for d in dists if scores[d] is not None), key=scores.get)
+        unknown = [d for d in dists if scores[d] is None]
+        random.shuffle(unknown)
+        best = known[:MAX_PROBES // 2]
+        candidates = (best + unknown)[:MAX_PROBES]
+        candidates += known[len(best):][:MAX_PROBES - len(candidates)]
+        with ThreadPoolExecutor(max_workers=max(len(candidates), 1)) as pool:
+            for dist, latency in zip(candidates, pool.map(lambda d: self.try_probe(chain, d), candidates)):
+                if latency is None:
+                    self.record_failure(dist)
+                else:
+                    self.record_probe(dist, latency)
+        self.save()
+        scores = {d: self.score(d, chunk_len) for d in dists}
+        return sorted(dists, key=lambda d: (scores[d] is None, scores[d] or 0))[:count]
+
+    def try_probe(self, chain, dist):
+        try:
+            return probe(chain.get_user_info(dist)[3])
+        except Exception:
+            return None
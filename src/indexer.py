@@ -0,0 +1,201 @@
+import os
+import json
+import time
+import threading
+from web3 import Web3
+from src.bitmap import to_bitmap, from_bitmap
+# Blocks after which logs are considered final and written to the checkpoint
+CONFIRMATIONS = 2
+# Most blocks read per eth_getLogs call
+LOG_RANGE = 1000
+# Seconds between two reads of new blocks
+POLL_INTERVAL = 1.0
+# Seconds without a successful sync before answers are no longer trusted
+MAX_LAG = 10
+# Seconds between two checkpoints written to disk
+CHECKPOINT_INTERVAL = 30
+
+class State:
+    # Sessions we are the listener or the distributor of, and whether we distribute
+    # each song whose registration changed since the first indexed block.
+    # A state with a base only holds what changed in blocks that may still be
+    # reorganised, sessions of the base are copied before being changed
+    def __init__(self, address, base=None):
+        self.address = address
+        self.base = base
+        self.sessions = {}
+        self.distributing = dict(base.distributing) if base else {}
+
+    def get(self, id):
+        if id in self.sessions:
+            return self.sessions[id]
+        return self.base.get(id) if self.base else None
+
+    def touch(self, id):
+        if id not in self.sessions and self.base is not None:
+            session = self.base.get(id)
+            if session is not None:
+                self.sessions[id] = session[:6] + [set(session[6])]
+        return self.sessions.get(id)
+
+    def apply(self, name, args):
+        match name:
+            case 'SessionCreated':
+                if self.address in (args['listener'], args['distributor']):
+                    self.sessions['0x'+args['session'].hex()] = [True, args['listener'], args['distributor'],
+                        '0x'+args['song'].hex(), args['price'], args['balance'], set()]
+            case 'ChunkPaid':
+                session = self.touch('0x'+args['session'].hex())
+                if session is not None:
+                    session[6].add(args['index'])
+                    session[5] -= args['amount']
+            case 'SessionClosed':
+                if self.base is None:
+                    # Closed for good, the contract answers for it from now on
+                    self.sessions.pop('0x'+args['session'].hex(), None)
+                    return
+                session = self.touch('0x'+args['session'].hex())
+                if session is not None:
+                    session[0], session[5] = False, 0
+            case 'DistributorChanged':
+                if args['distributor'] == self.address:
+                    self.distributing['0x'+args['song'].hex()] = args['distributing']
+
+class Indexer:
+    def __init__(self, chain, filename=None, confirmations=CONFIRMATIONS, interval=POLL_INTERVAL):
+        self.w3 = chain.w3
+        self.contract = chain.contract
+        self.address = chain.account.address
+        self.confirmations = confirmations
+        self.interval = interval
+        if filename is None:
+            filename = f'tmp/index-{self.contract.address}-{self.address}.json'
+        self.filename = filename
+        # Events of the contract by their topic
+        self.events = {}
+        for e in self.contract.abi:
+            if e['type'] == 'event':
+                signature = f"{e['name']}({','.join(i['type'] for i in e['inputs'])})"
+                self.events[Web3.keccak(text=signature)] = getattr(self.contract.events, e['name'])()
+        self.state = State(self.address)
+        self.view = State(self.address, self.state)
+        self.synced = 0
+        self.saved = time.monotonic()
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.load()
+
+    def load(self):
+        # Catch up from the last checkpoint, or start following from now
+        if os.path.exists(self.filename):
+            try:
+                with open(self.filename, 'r') as f:
+                    state = json.load(f)
+                self.first, self.block, self.hash = state['first'], state['block'], state['hash']
+                self.state.distributing = state['distributing']
+                for id,(active,listener,dist,song,price,balance,paid) in state['sessions'].items():
+                    self.state.sessions[id] = [active, listener, dist, song, price, balance, from_bitmap(paid)]
+                self.view = State(self.address, self.state)
+                return
+            except (ValueError, KeyError):
+                pass
+        self.first = self.w3.eth.block_number
+        self.reset()
+
+    def save(self):
+        if not os.path.exists(os.path.dirname(self.filename)):
+            os.makedirs(os.path.dirname(self.filename))
+        with open(self.filename + '.tmp', 'w') as f:
+            json.dump({
+                "first": self.first,
+                "block": self.block,
+                "hash": self.hash,
+                "distributing": self.state.distributing,
+                "sessions": {id: s[:6] + [to_bitmap(s[6])] for id,s in self.state.sessions.items()}
+            }, f)
+        os.replace(self.filename + '.tmp', self.filename)
+
+    def reset(self):
+        # Checkpoint is not part of the chain anymore, index again from the start
+        with self.lock:
+            self.state = State(self.address)
+            self.view = State(self.address, self.state)
+        self.block, self.hash = self.first - 1, None
+
+    def get_logs(self, start, end):
+        for i in range(start, end + 1, LOG_RANGE):
+            logs = self.w3.eth.get_logs({
+                "address": self.contract.address,
+                "fromBlock": i,
+                "toBlock": min(i + LOG_RANGE - 1, end)
+            })
+            for log in logs:
+                event = self.events.get(bytes(log['topics'][0])) if log['topics'] else None
+                if event is not None:
+                    yield event.event_name, event.process_log(log)['args']
+
+    def sync(self, max_age=0):
+        with self.sync_lock:
+            # Concurrent callers share a single read of the chain
+            if time.monotonic() - self.synced < max_age:
+                return
+            head = self.w3.eth.block_number
+            if self.hash is not None and self.w3.eth.get_block(self.block)['hash'].hex() != self.hash:
+                self.reset()
+            # Logs become final once enough blocks are built on top of them,
+            # more recent ones are read again on every sync and never persisted
+            safe = max(head - self.confirmations, self.block)
+            final = list(self.get_logs(self.block + 1, safe))
+            recent = list(self.get_logs(safe + 1, head))
+            with self.lock:
+                for name, args in final:
+                    self.state.apply(name, args)
+                self.view = State(self.address, self.state)
+                for name, args in recent:
+                    self.view.apply(name, args)
+            if safe > self.block:
+                self.block, self.hash = safe, self.w3.eth.get_block(safe)['hash'].hex()
+                # Logs after the checkpoint are read again on restart
+                if time.monotonic() - self.saved > CHECKPOINT_INTERVAL:
+                    self.checkpoint()
+            self.synced = time.monotonic()
+
+    def checkpoint(self):
+        self.save()
+        self.saved = time.monotonic()
+
+    def fresh(self):
+        return time.monotonic() - self.synced < MAX_LAG
+
+    def get_session(self, id):
+        # Session as stored in the contract, None when not known to the index
+        if not self.fresh():
+            return None
+        with self.lock:
+            session = self.view.get(id)
+            return None if session is None else tuple(session)
+
+    def is_distributing(self, song_id):
+        # None for songs registered before the first indexed block and unchanged since
+        if not self.fresh():
+            return None
+        with self.lock:
+            return self.view.distributing.get(song_id)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.sync()
+            except Exception:
+                # Answers fall back to the contract until the node is reachable again
+                pass
+
+    def start(self):
+        self.sync()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+        with self.sync_lock:
+            self.checkpoint()
@@ -0,0 +1,82 @@
+import os
+import csv
+import json
+import glob
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from src.upload import Upload
+# Amount of files hashed at once
+HASH_WORKERS = os.cpu_count() or 4
+# Maximum amount of upload transactions waiting for their receipt
+MAX_IN_FLIGHT = 32
+
+def read_manifest(source, price=None):
+    # Songs to upload as (path, name, price) from a directory or a CSV/JSON manifest
+    if os.path.isdir(source):
+        if price is None:
+            raise Exception('A price is needed to upload a directory')
+        return [(f, os.path.splitext(os.path.basename(f))[0], price)
+            for f in sorted(glob.glob(os.path.join(source, '*.mp3')))]
+    base = os.path.dirname(source)
+    with open(source, 'r', newline='') as f:
+        rows = json.load(f) if source.endswith('.json') else list(csv.DictReader(f))
+    entries = []
+    for row in rows:
+        path = os.path.join(base, row['path'])
+        name = row.get('name') or os.path.splitext(os.path.basename(path))[0]
+        p = float(row['price']) if row.get('price') not in (None, '') else price
+        if p is None:
+            raise Exception(f'No price given for {path}')
+        entries.append((path, name, p))
+    return entries
+
+class Ingest:
+    def __init__(self, chain, chunk_len, merkle=False, chunk_ms=None, workers=HASH_WORKERS, max_in_flight=MAX_IN_FLIGHT):
+        self.chain = chain
+        self.chunk_len = chunk_len
+        self.merkle = merkle
+        self.chunk_ms = chunk_ms
+        self.workers = workers
+        self.max_in_flight = max_in_flight
+        self.uploaded = []
+        self.failed = []
+
+    def run(self, entries):
+        # Files are hashed in parallel while earlier ones are being uploaded
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='hash') as pool:
+            for (path, _, _), upload in zip(entries, pool.map(self.hash, entries)):
+                if upload is None:
+                    self.failed.append(path)
+                    continue
+                try:
+                    pending.append((upload, self.chain.upload_async(upload)))
+                except Exception as e:
+                    print(f'Could not upload {path}: {e}')
+                    self.failed.append(path)
+                if len(pending) >= self.max_in_flight:
+                    self.confirm(*pending.popleft())
+        while pending:
+            self.confirm(*pending.popleft())
+        return self.uploaded
+
+    def hash(self, entry):
+        path, name, price = entry
+        try:
+            return Upload(path, self.chunk_len, self.merkle, name, price, self.chunk_ms)
+        except Exception as e:
+            print(f'Could not read {path}: {e}')
+            return None
+
+    def confirm(self, upload, receipt):
+        try:
+            if not receipt.result().status:
+                raise Exception('Execution failed (upload_song)')
+            upload.id = self.chain.gen_song_id(upload.name)
+            upload.save()
+        except Exception as e:
+            print(f'Could not upload {upload.filename}: {e}')
+            self.failed.append(upload.filename)
+            return
+        self.uploaded.append(upload)
+        print(f'Uploaded {upload.name} ({upload.id})')
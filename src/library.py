@@ -0,0 +1,128 @@
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from src.store import ChunkStore, load_index
+from src.merkle import chunk_hash, leaf_hash, merkle_root, HASH_LEN
+DB_FILE = "tmp/library.db"
+MAGIC_BYTES = b'ID3'
+# Files hashed and songs checked against the chain at once
+WORKERS = 8
+
+class Library:
+    # Songs held in the downloads directory, hashed once per version of the file
+    # and checked once against the chain
+    def __init__(self, chain, chunk_len, directory='downloads', filename=DB_FILE, workers=WORKERS):
+        self.chain = chain
+        self.chunk_len = chunk_len
+        self.directory = directory
+        self.workers = workers
+        if not os.path.exists(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        self.db = sqlite3.connect(filename)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS files (
+                id TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                chunks INTEGER NOT NULL,
+                hashes BLOB,
+                verified INTEGER
+            );
+        """)
+        # Files are only verified against the contract they were checked with
+        if self.get_meta('contract') != chain.contract.address:
+            with self.db:
+                self.db.execute('UPDATE files SET verified = NULL')
+                self.set_meta('contract', chain.contract.address)
+
+    def get_meta(self, key):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, str(value)))
+
+    def scan(self):
+        # Hash files added or changed since the last scan and forget removed ones
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        known = {id: (size, mtime) for id,size,mtime in self.db.execute('SELECT id, size, mtime FROM files')}
+        found = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name.endswith('.mp3') and entry.is_file():
+                    id = entry.name[:-4]
+                    found[id] = self.stat(id, entry.stat())
+        changed = [id for id,version in found.items() if known.get(id) != version]
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='library') as pool, self.db:
+            for id, (chunks, hashes) in zip(changed, pool.map(self.hash, changed)):
+                size, mtime = found[id]
+                self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, NULL)',
+                    (id, size, mtime, chunks, hashes))
+            self.db.executemany('DELETE FROM files WHERE id = ?', [(id,) for id in known if id not in found])
+
+    def stat(self, id, stat):
+        # A new chunk layout changes the song as much as new contents
+        mtime = stat.st_mtime
+        index = os.path.join(self.directory, f'{id}.idx')
+        if os.path.exists(index):
+            mtime = max(mtime, os.path.getmtime(index))
+        return stat.st_size, mtime
+
+    def hash(self, id):
+        filename = os.path.join(self.directory, f'{id}.mp3')
+        try:
+            with open(filename, 'rb') as f:
+                if f.read(3) != MAGIC_BYTES:
+                    return 0, None
+            store = ChunkStore(self.chunk_len, 1)
+            store.add(id, filename, load_index(os.path.join(self.directory, f'{id}.idx')))
+            try:
+                chunks = store.chunks_len(id)
+                return chunks, b''.join(chunk_hash(store.get_chunk(id, i)) for i in range(chunks))
+            finally:
+                store.close()
+        except ValueError as e:
+            print(e)
+            return 0, None
+        except OSError:
+            return 0, None
+
+    def verify(self):
+        # Check files never checked before against the song committed on chain
+        rows = self.db.execute('SELECT id, chunks, hashes FROM files WHERE verified IS NULL AND hashes IS NOT NULL').fetchall()
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='library') as pool:
+            results = list(pool.map(lambda row: self.check(*row), rows))
+        with self.db:
+            self.db.executemany('UPDATE files SET verified = ? WHERE id = ?',
+                [(int(valid), id) for (id,_,_), valid in zip(rows, results) if valid is not None])
+
+    def check(self, id, chunks, hashes):
+        # None when the chain could not be read, to try again on the next scan
+        try:
+            if self.chain.get_song_metadata(id)[2] != chunks:
+                return False
+            digests = [hashes[i:i+HASH_LEN] for i in range(0, len(hashes), HASH_LEN)]
+            root = self.chain.get_merkle_root(id)
+            if root is not None:
+                return merkle_root([leaf_hash(h) for h in digests]) == root
+            return self.chain.get_chunk_hashes(id) == ['0x'+h.hex() for h in digests]
+        except Exception:
+            return None
+
+    def is_verified(self, id):
+        row = self.db.execute('SELECT verified FROM files WHERE id = ?', (id,)).fetchone()
+        return bool(row and row[0])
+
+    def songs(self):
+        # Verified songs of the library still listed on chain, as (id, name, author)
+        self.scan()
+        self.verify()
+        verified = {id for id, in self.db.execute('SELECT id FROM files WHERE verified')}
+        return [(id,name,auth) for id,name,auth,_ in self.chain.get_song_list() if id in verified]
+
+    def distributing(self, ids, indexed=True):
+        # Songs we are registered as distributor of, from the contract itself unless indexed
+        ids = list(ids)
+        return {id for id,distributing in zip(ids, self.chain.get_distributing(ids, indexed=indexed)) if distributing}
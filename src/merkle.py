@@ -0,0 +1,60 @@
+import hashlib
+# Size of every hash in the tree and in proofs
+HASH_LEN = 32
+# Leaves and nodes are hashed with different prefixes so one can not pass for the other
+LEAF = b'\x00'
+NODE = b'\x01'
+
+def chunk_hash(chunk):
+    # Hash of a chunk, as stored on chain for songs without a Merkle root
+    return hashlib.sha3_256(chunk).digest()
+
+def leaf_hash(digest):
+    # Leaves commit to the chunk's hash
+    return hashlib.sha3_256(LEAF + digest).digest()
+
+def node_hash(left, right):
+    return hashlib.sha3_256(NODE + left + right).digest()
+
+def merkle_levels(leaves):
+    # Every level of the tree from the leaves up to the root,
+    # a node without sibling is carried up to the next level
+    levels = [list(leaves)]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        parents = [node_hash(level[i], level[i+1]) for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            parents.append(level[-1])
+        levels.append(parents)
+    return levels
+
+def merkle_root(leaves):
+    return merkle_levels(leaves)[-1][0]
+
+def merkle_proof(levels, index):
+    # Siblings on the path from a leaf to the root, concatenated
+    proof = []
+    for level in levels[:-1]:
+        sibling = index ^ 1
+        if sibling < len(level):
+            proof.append(level[sibling])
+        index //= 2
+    return b''.join(proof)
+
+def verify_proof(leaf, index, count, proof, root):
+    if index >= count or len(proof) % HASH_LEN:
+        return False
+    siblings = [proof[i:i+HASH_LEN] for i in range(0, len(proof), HASH_LEN)]
+    node = leaf
+    while count > 1:
+        if index % 2:
+            if not siblings:
+                return False
+            node = node_hash(siblings.pop(0), node)
+        elif index + 1 < count:
+            if not siblings:
+                return False
+            node = node_hash(node, siblings.pop(0))
+        index //= 2
+        count = (count + 1) // 2
+    return not siblings and node == root
@@ -0,0 +1,92 @@
+import os
+import json
+import time
+import threading
+from collections import deque, Counter
+from contextlib import nullcontext
+# Latest samples kept for every timer
+WINDOW = 1000
+# Handed out by every timer while disabled
+NO_TIMER = nullcontext()
+
+class Timer:
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start)
+        return False
+
+class Metrics:
+    # Stage timings and call counters, every method is a no-op while disabled
+    def __init__(self, enabled=False, window=WINDOW):
+        self.enabled = enabled
+        self.window = window
+        self.counters = Counter()
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def timer(self, name):
+        if not self.enabled:
+            return NO_TIMER
+        return Timer(self, name)
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] += n
+
+    def observe(self, name, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            if name not in self.samples:
+                self.samples[name] = deque(maxlen=self.window)
+            self.samples[name].append(seconds)
+            self.counters[name] += 1
+
+    def histogram(self, samples):
+        samples = sorted(samples)
+        pick = lambda p: 1000 * samples[min(len(samples) - 1, int(len(samples) * p))]
+        return {
+            "samples": len(samples),
+            "mean_ms": 1000 * sum(samples) / len(samples),
+            "p50_ms": pick(0.5),
+            "p90_ms": pick(0.9),
+            "p99_ms": pick(0.99),
+            "max_ms": 1000 * samples[-1]
+        }
+
+    def snapshot(self, reset=False):
+        # With reset, the next snapshot only holds what is measured after this one
+        with self.lock:
+            counters = dict(self.counters)
+            samples = {name: list(s) for name,s in self.samples.items() if s}
+            if reset:
+                self.counters.clear()
+                self.samples.clear()
+        return {
+            "counters": counters,
+            "timers": {name: self.histogram(s) for name,s in samples.items()}
+        }
+
+    def dump(self, filename, reset=False):
+        if not self.enabled:
+            return
+        if not os.path.exists(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        snapshot = self.snapshot(reset)
+        with open(filename, 'w') as f:
+            json.dump(snapshot, f, indent=4)
+
+# Shared by the whole client, enabled with metrics.enable()
+metrics = Metrics()
@@ -0,0 +1,79 @@
+import struct
+# Every entry of a chunk index is the chunk's byte offset and start time in ms
+ENTRY = struct.Struct('>II')
+# Bitrates in kbps by [version is MPEG1][layer], layers are I, II and III
+BITRATES = {
+    (True, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (True, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (False, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (False, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+# Sample rates by version bits, MPEG2.5, reserved, MPEG2 and MPEG1
+SAMPLE_RATES = {0: (11025, 12000, 8000), 2: (22050, 24000, 16000), 3: (44100, 48000, 32000)}
+
+def id3_len(data):
+    # Size of the ID3v2 tag at the start of the file, if any
+    if len(data) < 10 or data[:3] != b'ID3':
+        return 0
+    size = 0
+    for b in data[6:10]:
+        size = size << 7 | b & 0x7f
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+def parse_header(data, offset):
+    # Length and samples of the frame starting at offset, None if not a frame
+    if offset + 4 > len(data) or data[offset] != 0xff or data[offset+1] & 0xe0 != 0xe0:
+        return None
+    version = data[offset+1] >> 3 & 3
+    layer = 4 - (data[offset+1] >> 1 & 3)
+    bitrate = data[offset+2] >> 4
+    rate = data[offset+2] >> 2 & 3
+    padding = data[offset+2] >> 1 & 1
+    if version == 1 or layer == 4 or bitrate in (0, 15) or rate == 3:
+        return None
+    mpeg1 = version == 3
+    bitrate = BITRATES[(mpeg1, layer)][bitrate] * 1000
+    sample_rate = SAMPLE_RATES[version][rate]
+    if layer == 1:
+        return (12 * bitrate // sample_rate + padding) * 4, 384, sample_rate
+    samples = 1152 if layer == 2 or mpeg1 else 576
+    return samples // 8 * bitrate // sample_rate + padding, samples, sample_rate
+
+def frames(data):
+    # Offset and duration in seconds of every frame, bytes between frames are skipped
+    offset = id3_len(data)
+    while offset + 4 <= len(data):
+        header = parse_header(data, offset)
+        if header is None or offset + header[0] > len(data):
+            offset += 1
+            continue
+        length, samples, sample_rate = header
+        yield offset, samples / sample_rate
+        offset += length
+
+def chunk_index(data, chunk_ms):
+    # Cut chunks on frame boundaries once they hold at least chunk_ms of audio,
+    # tags and stray bytes stay with the chunk they are found in
+    index = [(0, 0)]
+    elapsed = start = 0
+    for offset, duration in frames(data):
+        if (elapsed - start) * 1000 >= chunk_ms:
+            index.append((offset, round(elapsed * 1000)))
+            start = elapsed
+        elapsed += duration
+    if elapsed == 0:
+        return None
+    # Last entry marks the end of the song
+    index.append((len(data), round(elapsed * 1000)))
+    return index
+
+def pack_index(index):
+    return b''.join(ENTRY.pack(*entry) for entry in index)
+
+def unpack_index(data):
+    if not data or len(data) % ENTRY.size:
+        return None
+    return list(ENTRY.iter_unpack(data))
@@ -0,0 +1,37 @@
+import hmac
+import struct
+import hashlib
+# Every message is prefixed by its length as a 4 byte big-endian integer
+HEADER = struct.Struct('>I')
+MAX_FRAME_LEN = 1 << 24
+# Requests received by the server are small, even before authentication
+MAX_REQUEST_LEN = 1024
+
+def send_frame(sock, data):
+    if len(data) < 4096:
+        sock.sendall(HEADER.pack(len(data)) + data)
+    else:
+        # Avoid copying large payloads such as memory-mapped chunks
+        sock.sendall(HEADER.pack(len(data)))
+        sock.sendall(data)
+
+def recv_exact(sock, n):
+    data = bytearray(n)
+    view = memoryview(data)
+    read = 0
+    while read < n:
+        r = sock.recv_into(view[read:], n - read)
+        if r == 0:
+            raise ConnectionError('connection closed by peer')
+        read += r
+    return bytes(data)
+
+def recv_frame(sock, max_len=MAX_FRAME_LEN):
+    length, = HEADER.unpack(recv_exact(sock, HEADER.size))
+    if length > max_len:
+        raise ConnectionError(f'frame too large ({length} bytes)')
+    return recv_exact(sock, length)
+
+def session_mac(token, id, index):
+    # Authorise a chunk request with the token issued on authentication
+    return hmac.new(token, f'{id}:{index}'.encode(), hashlib.sha256).hexdigest()
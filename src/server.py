@@ -1,11 +1,102 @@
 import os
 import ssl
+import hmac
+import time
 import socket
-from OpenSSL import crypto
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519, rsa
+from src.store import ChunkStore, load_index
+from src.protocol import send_frame, recv_frame, session_mac, MAX_REQUEST_LEN
 CRT_FILE, KEY_FILE = "tmp/server.crt", "tmp/priv.key"
+# Key of new server identities, one of ec, ed25519 or rsa
+KEY_TYPE = 'ec'
+# Seconds a listener may stay silent before its connection is dropped
+IDLE_TIMEOUT = 60
+# Seconds before an authenticated session is checked again on chain
+SESSION_TTL = 30
+
+class SessionCache:
+    def __init__(self, chain, ttl=SESSION_TTL):
+        self.chain = chain
+        self.ttl = ttl
+        self.entries = {}
+        # Chunks known to be paid in every session
+        self.paid = {}
+        # Open connections authenticated for every session
+        self.connections = Counter()
+        self.lock = threading.Lock()
+
+    def check(self, id):
+        # Get session information
+        active,addr,dist,song_id,p,_ = tuple(self.chain.get_session_info(id))
+        # Check session is correct
+        if not active or dist != self.chain.account.address:
+            self.evict(id)
+            raise Exception('session not active or incorrect distributor')
+        return addr, song_id, p
+
+    def authenticate(self, id, signature):
+        addr, song_id, p = self.check(id)
+        # Check sender is session listener
+        if not self.chain.verify_message(id, signature, addr):
+            raise Exception('message sender does not correspond with session listener')
+        with self.lock:
+            # Reuse the token of a session already authenticated
+            entry = self.entries.get(id)
+            token = entry[3] if entry is not None else os.urandom(32)
+            self.entries[id] = (addr, song_id, p, token, time.monotonic() + self.ttl)
+        return token
+
+    def authorize(self, id, index, mac):
+        entry = self.entries.get(id)
+        if entry is None:
+            raise Exception('session not authenticated')
+        addr, song_id, p, token, expires = entry
+        if not hmac.compare_digest(session_mac(token, id, index), mac):
+            raise Exception('invalid session token')
+        if time.monotonic() > expires:
+            # Make sure the session has not been closed in the meantime
+            self.check(id)
+            with self.lock:
+                self.entries[id] = (addr, song_id, p, token, time.monotonic() + self.ttl)
+        return addr, song_id, p
+
+    def is_paid(self, id, index, chunks_len):
+        # Every payment of the session is read at once, and only when one is missing
+        paid = self.paid.get(id, ())
+        if index not in paid:
+            paid = self.chain.get_paid_chunks(id, chunks_len, index)
+            with self.lock:
+                self.paid[id] = paid
+        return index in paid
+
+    def attach(self, id):
+        with self.lock:
+            self.connections[id] += 1
+
+    def detach(self, id):
+        # Forget a session once its listener has no connection left
+        with self.lock:
+            self.connections[id] -= 1
+            if self.connections[id] <= 0:
+                del self.connections[id]
+                self.entries.pop(id, None)
+                self.paid.pop(id, None)
+
+    def evict(self, id):
+        with self.lock:
+            self.entries.pop(id, None)
+            self.paid.pop(id, None)
 
 class Server:
-    def __init__(self, port, chain, chunk_len, debug=False):
+    def __init__(self, port, chain, chunk_len, debug=False, backlog=128, max_connections=256, max_open_songs=64, key_type=KEY_TYPE,
+            host='localhost', public_host=None):
         self.chain = chain
         self.chunk_len = chunk_len
         self.debug = debug
@@ -13,82 +104,184 @@ class Server:
         # Create a TCP/IP socket
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.settimeout(0.2)
+        # Take the port back right after a restart, while old connections are in TIME_WAIT
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
-        # Create SSL context
-        cert_gen()
+        # Bind the socket to the port before anything else, it may be taken
+        server_address = (host, port)
+        try:
+            self.sock.bind(server_address)
+        except OSError:
+            self.sock.close()
+            raise
+
+        # Create SSL context from the persisted identity
+        cert = load_identity(key_type)
         self.context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
         self.context.load_cert_chain(certfile=CRT_FILE, keyfile=KEY_FILE)
-
-        # Bind the socket to the port
-        server_address = ('localhost', port)
-        self.sock.bind(server_address)
-        with open(CRT_FILE, 'r') as c:
-            self.url = f'{server_address[0]}:{server_address[1]}:{c.read()}'
+        # Listeners reach the server at its public name when bound to every interface
+        self.url = f'{public_host or host}:{port}:{cert}'
 
         # Listen for incoming connections
-        self.sock.listen(1)
+        self.sock.listen(backlog)
 
-        # Initialize song dictionary
+        # Serve each connection on a bounded pool of workers
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self.pool = ThreadPoolExecutor(max_workers=max_connections, thread_name_prefix='server')
+        self.connections = set()
+        self.lock = threading.Lock()
+
+        # Initialize song dictionary, chunk store and authenticated sessions
         self.songs = {}
+        self.roots = {}
+        self.store = ChunkStore(chunk_len, max_open_songs)
+        self.sessions = SessionCache(chain)
         self.closed = False
+        self.monitor_done = threading.Event()
 
         print(f'serving music on {self.url.split(":")[:-1]}')
 
     def monitor(self):
         self.debug = True
+        self.monitor_done.clear()
         print(f"""
-Currently serving {len(self.songs.keys())} songs.
+Currently serving {len(self.songs.keys())} songs to {len(self.connections)} listeners.
         """)
 
+    def stop_monitor(self):
+        self.debug = False
+        self.monitor_done.set()
+
     def new_song(self, song):
         id,name,auth = song
-        filename = f'downloads/{id}.mp3'
-        with open(filename, 'rb') as f:
-            data = f.read()
-        self.songs[id] = [data[i:i+self.chunk_len] for i in range(0, len(data), self.chunk_len)]
+        try:
+            self.store.add(id, f'downloads/{id}.mp3', load_index(f'downloads/{id}.idx'))
+        except (OSError, ValueError) as e:
+            print(f'Not serving {name} by {auth}: {e}')
+            return
+        self.songs[id] = song
         print(f'Serving new song: {name} by {auth}')
 
     def close(self):
         self.closed = True
+        # Wake up workers blocked on their listeners
+        with self.lock:
+            for conn in self.connections:
+                try:
+                    # Bypass the TLS layer, which is owned by the worker
+                    socket.socket.shutdown(conn, socket.SHUT_RDWR)
+                except OSError:
+                    pass
 
-    def respond(self, conn, msg):
+    def respond(self, conn, msg, ids):
         try:
-            id, index, signature = tuple(msg.decode().split(':'))
-            # Get session information
-            active,addr,dist,song_id,p,_ = tuple(self.chain.get_session_info(id))
-            # Check session is correct
-            if not active or dist != self.chain.account.address:
-                raise Exception('session not active or incorrect distributor')
-            # Check sender is session listener
-            if not self.chain.verify_message(f'{id}:{index}', signature, addr):
-                raise Exception('message sender does not correspond with session listener')
-            # Check chunk is paid
-            if not self.chain.is_chunk_paid(id, int(index)):
-                raise Exception('chunk index has not yet been paid')
-            # send chunk
-            chunk = self.songs[song_id][int(index)]
-            conn.sendall(chunk)
-            if self.debug:
-                print(f"Sent chunk {index} of {song_id} to {addr}: {p/len(self.songs[song_id]) * 0.1} Mi received")
+            cmd, *args = msg.decode().split(':')
+            match cmd:
+                case 'AUTH':
+                    frames = [self.sessions.authenticate(*args).hex().encode()]
+                    # Sessions authenticated on the connection
+                    if args[0] not in ids:
+                        ids.add(args[0])
+                        self.sessions.attach(args[0])
+                case 'GET':
+                    frames = self.get_chunk(*args)
+                case 'INDEX':
+                    frames = [self.get_index(*args)]
+                case 'PING':
+                    frames = [b'PONG']
+                case _:
+                    raise Exception('unknown request')
         except Exception as e:
             if self.debug:
                 print(f'Bad request: {e}\n\twith msg: {msg}')
+            # Answer with an empty frame so pipelined requests stay in order
+            send_frame(conn, b'')
+            return
+        for frame in frames:
+            send_frame(conn, frame)
+
+    def get_chunk(self, id, index, mac):
+        # Check sender holds the session token
+        addr, song_id, p = self.sessions.authorize(id, index, mac)
+        # Check chunk is paid
+        if not self.sessions.is_paid(id, int(index), self.store.chunks_len(song_id)):
+            raise Exception('chunk index has not yet been paid')
+        chunk = self.store.get_chunk(song_id, int(index))
+        if self.debug:
+            print(f"Sent chunk {index} of {song_id} to {addr}: {p/self.store.chunks_len(song_id) * 0.1} Mi received")
+        # Songs committed by a Merkle root are followed by the chunk's proof
+        if self.get_root(song_id) is None:
+            return [chunk]
+        return [chunk, self.store.get_proof(song_id, int(index))]
+
+    def get_index(self, id, mac):
+        # Chunk layout of the session's song, empty for fixed size chunks
+        _, song_id, _ = self.sessions.authorize(id, 'INDEX', mac)
+        return self.store.get_index(song_id)
+
+    def get_root(self, song_id):
+        if song_id not in self.roots:
+            self.roots[song_id] = self.chain.get_merkle_root(song_id)
+        return self.roots[song_id]
+
+    def handle(self, conn):
+        ssl_conn = None
+        ids = set()
+        with self.lock:
+            self.connections.add(conn)
+        try:
+            conn.settimeout(IDLE_TIMEOUT)
+            ssl_conn = self.context.wrap_socket(conn, server_side=True)
+            with self.lock:
+                self.connections.discard(conn)
+                self.connections.add(ssl_conn)
+            with ssl_conn:
+                # Answer requests in order until the listener disconnects
+                while not self.closed:
+                    self.respond(ssl_conn, recv_frame(ssl_conn, MAX_REQUEST_LEN), ids)
+        except OSError:
+            pass
+        finally:
+            for id in ids:
+                self.sessions.detach(id)
+            with self.lock:
+                self.connections.discard(conn)
+                self.connections.discard(ssl_conn)
+            conn.close()
+            self.slots.release()
 
     def run(self):
-        while not self.closed:
-            try:
-                # Wait for a connection or timeout
-                conn, _ = self.sock.accept()
-                ssl_conn = self.context.wrap_socket(conn, server_side=True)
+        try:
+            while not self.closed:
+                # Leave new connections in the backlog while every slot is busy
+                if not self.slots.acquire(timeout=0.2):
+                    continue
                 try:
-                    msg = ssl_conn.recv(256)
-                    self.respond(ssl_conn, msg)
-                finally:
-                    ssl_conn.close()
-            except socket.timeout:
-                continue
+                    # Wait for a connection or timeout
+                    conn, _ = self.sock.accept()
+                except socket.timeout:
+                    self.slots.release()
+                    continue
+                if self.closed:
+                    conn.close()
+                    self.slots.release()
+                    break
+                self.pool.submit(self.handle, conn)
+        finally:
+            self.sock.close()
+            self.pool.shutdown(wait=True)
+            self.store.close()
+
+def load_identity(key_type=KEY_TYPE):
+    # Key and certificate are generated once and reused across restarts,
+    # so the url published on chain stays the same
+    if not (os.path.exists(CRT_FILE) and os.path.exists(KEY_FILE)):
+        cert_gen(key_type)
+    with open(CRT_FILE, 'r') as c:
+        return c.read()
 
 def cert_gen(
+    key_type=KEY_TYPE,
     emailAddress="emailAddress",
     commonName="commonName",
     countryName="NT",
@@ -96,28 +289,37 @@ def cert_gen(
     stateOrProvinceName="stateOrProvinceName",
     organizationName="organizationName",
     organizationUnitName="organizationUnitName"):
-    # Create a key pair
-    k = crypto.PKey()
-    k.generate_key(crypto.TYPE_RSA, 4096)
+    # Create a key pair, elliptic curve keys are generated and used in handshakes
+    # much faster than RSA ones
+    match key_type:
+        case 'ed25519':
+            k, digest = ed25519.Ed25519PrivateKey.generate(), None
+        case 'ec':
+            k, digest = ec.generate_private_key(ec.SECP256R1()), hashes.SHA256()
+        case 'rsa':
+            k, digest = rsa.generate_private_key(public_exponent=65537, key_size=4096), hashes.SHA512()
+        case _:
+            raise ValueError(f'unknown key type {key_type}')
     # Create a self-signed cert
-    cert = crypto.X509()
-    cert.get_subject().C = countryName
-    cert.get_subject().ST = stateOrProvinceName
-    cert.get_subject().L = localityName
-    cert.get_subject().O = organizationName
-    cert.get_subject().OU = organizationUnitName
-    cert.get_subject().CN = commonName
-    cert.get_subject().emailAddress = emailAddress
-    cert.set_serial_number(0)
-    cert.gmtime_adj_notBefore(0)
-    cert.gmtime_adj_notAfter(10*365*24*60*60)
-    cert.set_issuer(cert.get_subject())
-    cert.set_pubkey(k)
-    cert.sign(k, 'sha512')
-    # Write public and private key files
+    subject = x509.Name([
+        x509.NameAttribute(NameOID.COUNTRY_NAME, countryName),
+        x509.NameAttribute(NameOID.STATE_OR_PROVINCE_NAME, stateOrProvinceName),
+        x509.NameAttribute(NameOID.LOCALITY_NAME, localityName),
+        x509.NameAttribute(NameOID.ORGANIZATION_NAME, organizationName),
+        x509.NameAttribute(NameOID.ORGANIZATIONAL_UNIT_NAME, organizationUnitName),
+        x509.NameAttribute(NameOID.COMMON_NAME, commonName),
+        x509.NameAttribute(NameOID.EMAIL_ADDRESS, emailAddress)
+    ])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = x509.CertificateBuilder().subject_name(subject).issuer_name(subject) \
+        .public_key(k.public_key()).serial_number(x509.random_serial_number()) \
+        .not_valid_before(now).not_valid_after(now + datetime.timedelta(days=10*365)) \
+        .sign(k, digest)
+    # Write public and private key files, the key only readable by its owner
     if not os.path.exists('tmp'):
             os.makedirs('tmp')
-    with open(CRT_FILE, "w") as f:
-        f.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert).decode("utf-8"))
-    with open(KEY_FILE, "w") as f:
-        f.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, k).decode("utf-8"))
\ No newline at end of file
+    with open(CRT_FILE, "wb") as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    fd = os.open(KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with open(fd, "wb") as f:
+        f.write(k.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()))
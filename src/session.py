@@ -1,88 +1,273 @@
 import os
 import ssl
+import time
 import socket
 import hashlib
-CRT_FILE = "tmp/other.crt"
+import threading
+from collections import deque
+from src.protocol import send_frame, recv_frame, session_mac
+from src.merkle import chunk_hash, leaf_hash, verify_proof
+from src.mp3 import unpack_index
+from src.store import ChunkStore, load_index
+from src.metrics import metrics
+# Maximum amount of chunk requests in flight on the connection
+PIPELINE_DEPTH = 4
 
 def keccak(data):
     return '0x' + hashlib.sha3_256(data).hexdigest()
 
+class TlsState:
+    # SSL context of a distributor and the last TLS session negotiated with it,
+    # new connections resume it instead of doing a full handshake
+    def __init__(self, cert):
+        self.context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        self.context.verify_mode = ssl.CERT_REQUIRED
+        self.context.load_verify_locations(cadata=cert)
+        self.session = None
+
+# Shared by every session of the client, by server address and certificate
+tls_states = {}
+tls_lock = threading.Lock()
+
+def get_tls_state(address, cert):
+    with tls_lock:
+        if (address, cert) not in tls_states:
+            tls_states[(address, cert)] = TlsState(cert)
+        return tls_states[(address, cert)]
+
+def parse_server_url(url):
+    # Server url published on chain, ip:port:certificate
+    ip_addr, port, cert = url.split(':')
+    return (ip_addr, int(port)), cert
+
 class Session:
-    def __init__(self, chain, chunk_len):
+    def __init__(self, chain, chunk_len, timeout=None, health=None):
         self.chain = chain
+        self.health = health
         self.chunk_len = chunk_len
+        self.timeout = timeout
         self.active = True
         self.on_chain = False
-        self.paid_chunks = []
+        self.paid_chunks = set()
+        self.conn = None
+        self.token = None
+        self.index = None
+        # Requests sent and not answered yet, with the time they were sent
+        self.pending = deque()
+        # When the last response was fully received
+        self.received = 0
+        self.close_callbacks = []
 
-    def create(self, song):
+    def create(self, song, distributor=None):
         self.song_id, self.song_name, self.song_auth, self.song_p = song
         # Check balance
         funds = self.chain.get_contract_balance()
         if self.song_p > funds:
             raise Exception(f'\nInsufficient contract funds: {self.song_p-funds} Mi left')
+        # Pick the distributor expected to serve chunks the fastest
+        if distributor is None and self.health is not None:
+            dists = self.chain.get_distributors(self.song_id)
+            if dists:
+                distributor = self.health.select(self.chain, dists, self.chunk_len)[0]
         # Create session in ISC
-        self.id, dist = self.chain.create_session(self.song_id)
+        self.id, dist = self.chain.create_session(self.song_id, distributor)
         if not self.id:
             raise Exception('Execution failed (create_session)')
         self.on_chain = True
+        self.setup(dist)
+
+    def resume(self, song, id, distributor):
+        # Reuse a session still active on chain and the chunks paid in it
+        self.song_id, self.song_name, self.song_auth, self.song_p = song
+        self.id = id
+        self.on_chain = True
+        self.setup(distributor)
+        self.paid_chunks = self.chain.get_paid_chunks(self.id, self.chunks_len)
+
+    def load_song(self):
         # Get metadata from ISC
         self.length, self.duration, self.chunks_len = self.chain.get_song_metadata(self.song_id)
+        # Get the Merkle root or every chunk hash once to verify chunks locally
+        self.root = self.chain.get_merkle_root(self.song_id)
+        self.hashes = None if self.root else self.chain.get_chunk_hashes(self.song_id)
+
+    def setup(self, dist):
+        self.dist = dist
+        self.load_song()
         # Get session provider
         try:
-            self.dist_name = self.chain.get_user_info(dist)[1]
-            ip_addr, port, cert = self.chain.get_user_info(dist)[3].split(':')
-            self.server_address = (ip_addr, int(port))
-            if not os.path.exists('tmp'):
-                os.makedirs('tmp')
-            with open(CRT_FILE, "w") as f:
-                f.write(cert)
+            _, self.dist_name, _, url, _, _ = self.chain.get_user_info(dist)
+            self.server_address, cert = parse_server_url(url)
+            # Create SSL context once for every session with the distributor
+            self.disconnect()
+            self.tls = get_tls_state(self.server_address, cert)
         except:
             raise Exception(f'Invalid distributor server ({dist})')
 
     def pay_chunk(self, index):
-        if not self.chain.get_chunk(self.id, index).status:
+        self.wait_payment(index, self.pay_chunk_async(index))
+
+    def pay_chunk_async(self, index):
+        # Returns a future of the payment receipt, or None if already paid
+        if index in self.paid_chunks:
+            return None
+        with metrics.timer('chunk.pay'):
+            payment = self.chain.get_chunk_async(self.id, index)
+        payment.add_done_callback(lambda p: self.paid(index, p))
+        return payment
+
+    def paid(self, index, payment):
+        if payment.exception() is None and payment.result().status:
+            self.paid_chunks.add(index)
+
+    def wait_payment(self, index, payment):
+        if payment is None:
+            return
+        with metrics.timer('chunk.receipt_wait'):
+            receipt = payment.result()
+        if not receipt.status:
             raise Exception('Execution failed (get_chunk)')
-        self.paid_chunks.append(index)
+        self.paid(index, payment)
 
-    def request_chunk(self, index):
-        # Create a TCP/IP socket
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # Create SSL context
-        context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
-        context.verify_mode = ssl.CERT_REQUIRED
-        context.load_verify_locations(CRT_FILE)
-        # Connect the socket to the server
-        sock.connect(self.server_address)
-        ssl_sock = context.wrap_socket(sock)
+    def connect(self):
+        # Open a single long-lived connection to the distributor
+        if self.conn is None:
+            with metrics.timer('session.connect'):
+                sock = socket.create_connection(self.server_address, self.timeout)
+                try:
+                    self.conn = self.tls.context.wrap_socket(sock, session=self.tls.session)
+                    self.authenticate()
+                    # Session tickets arrive after the handshake, keep the latest
+                    self.tls.session = self.conn.session
+                    if self.index is None:
+                        self.load_index()
+                except:
+                    self.disconnect()
+                    sock.close()
+                    self.record_failure()
+                    raise
+        return self.conn
+
+    def authenticate(self):
+        # Prove once that we are the session listener and get a session token
+        send_frame(self.conn, str.encode(f'AUTH:{self.id}:{self.chain.sign_message(self.id)}'))
+        token = recv_frame(self.conn)
+        if not token:
+            raise Exception(f'Session rejected by distributor ({self.dist_name})')
+        self.token = bytes.fromhex(token.decode())
+
+    def load_index(self):
+        # Offsets and start times of the song's chunks, if cut on MP3 frames
+        send_frame(self.conn, str.encode(f'INDEX:{self.id}:{session_mac(self.token, self.id, "INDEX")}'))
+        index = unpack_index(recv_frame(self.conn))
+        if index is None:
+            self.index = []
+            return
+        # Chunks are checked against the offsets once received
+        offsets = [offset for offset,_ in index]
+        if len(index) != self.chunks_len + 1 or offsets[0] != 0 or offsets[-1] != self.length \
+                or any(a >= b for a,b in zip(offsets, offsets[1:])):
+            raise Exception(f'Invalid chunk index from distributor ({self.dist_name})')
+        self.index = index
+
+    def chunk_time(self, index):
+        # Exact start of a chunk in ms, None when only known approximately
+        if self.index:
+            return self.index[index][1]
+        return None
+
+    def disconnect(self):
+        self.pending.clear()
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            finally:
+                self.conn = None
+
+    def send_request(self, index):
+        try:
+            conn = self.connect()
+            # Form message with session id, chunk index and session token MAC
+            with metrics.timer('chunk.request'):
+                send_frame(conn, str.encode(f'GET:{self.id}:{index}:{session_mac(self.token, self.id, index)}'))
+        except OSError:
+            self.disconnect()
+            raise
+        self.pending.append((index, time.monotonic()))
+
+    def recv_response(self):
+        # Responses arrive in the same order requests were sent
+        index, sent = self.pending.popleft()
         try:
-            # Form message with session id and chunk index
-            msg = f'{self.id}:{index}'
-            # Sign message
-            signed_msg = f'{msg}:{self.chain.sign_message(msg)}'
-            # Send data
-            ssl_sock.sendall(str.encode(signed_msg))
-            # https://stackoverflow.com/questions/52139071/python-ssl-recv-being-offset-when-data-larger-than-1400
-            d = ssl_sock.recv(16384)
-            data = d
-            while len(d) > 0:
-                d = ssl_sock.recv(16384)
-                data += d
-            return data if data else None
-        finally:
-            sock = ssl_sock.close()
-
-    def is_valid(self, index, chunk):
-        return self.chain.check_chunk(self.song_id, index, chunk)
+            with metrics.timer('chunk.transfer'):
+                data = recv_frame(self.conn)
+                # Chunks of Merkle songs are followed by their proof
+                proof = recv_frame(self.conn) if data and self.root else None
+        except OSError:
+            self.disconnect()
+            self.record_failure()
+            raise
+        # Transfer starts when the request is sent, or once the response before it
+        # is received since the connection carries one response at a time
+        start = max(sent, self.received)
+        self.received = time.monotonic()
+        if data and self.health is not None:
+            self.health.record_transfer(self.dist, len(data), self.received - start)
+        return index, data if data else None, proof
+
+    def request_chunk(self, index):
+        self.send_request(index)
+        return self.recv_response()[1]
+
+    def is_valid(self, index, chunk, proof=None):
+        if self.index and len(chunk) != self.index[index+1][0] - self.index[index][0]:
+            return False
+        if self.root:
+            return proof is not None and verify_proof(leaf_hash(chunk_hash(chunk)), index, self.chunks_len, proof, self.root)
+        return index < len(self.hashes) and self.hashes[index] == keccak(chunk)
 
     def get_chunk(self, index):
-        if index not in self.paid_chunks:
-            self.pay_chunk(index)
-        chunk = self.request_chunk(index)
-        if not chunk or not self.is_valid(index, keccak(chunk)):
+        with metrics.timer('chunk.total'):
+            if index not in self.paid_chunks:
+                self.pay_chunk(index)
+            self.send_request(index)
+            return self.verified_response()
+
+    def get_chunks(self, indices, depth=PIPELINE_DEPTH):
+        # Keep several payments and requests in flight and yield chunks in order
+        payments = deque()
+        try:
+            for index in indices:
+                payments.append((index, self.pay_chunk_async(index)))
+                if len(payments) >= depth:
+                    self.send_paid_request(*payments.popleft())
+                if len(self.pending) >= depth:
+                    yield self.verified_response()
+            while payments:
+                self.send_paid_request(*payments.popleft())
+            while self.pending:
+                yield self.verified_response()
+        except:
+            self.disconnect()
+            raise
+
+    def send_paid_request(self, index, payment):
+        self.wait_payment(index, payment)
+        self.send_request(index)
+
+    def verified_response(self):
+        index, chunk, proof = self.recv_response()
+        with metrics.timer('chunk.verify'):
+            valid = chunk and self.is_valid(index, chunk, proof)
+        if not valid:
+            self.record_failure()
             raise Exception('Chunk received is not valid')
         return chunk
 
+    def record_failure(self):
+        if self.health is not None:
+            self.health.record_failure(self.dist)
+
     def print_bill(self):
         total_paid = self.song_p * (len(self.paid_chunks) / self.chunks_len)
         auth_paid = total_paid / 1.1
@@ -102,4 +287,58 @@ class Session:
 
     def close(self):
         self.active = False
-        
\ No newline at end of file
+        self.disconnect()
+        # Keep what was measured during the session for the next runs
+        if self.health is not None:
+            self.health.save()
+        for callback in self.close_callbacks:
+            callback()
+        
+class LocalSession(Session):
+    # Session with ourselves as distributor of a song we already hold,
+    # chunks are still paid on chain but read from the local file
+    def __init__(self, chain, chunk_len, filename):
+        super().__init__(chain, chunk_len)
+        self.filename = filename
+        self.store = ChunkStore(chunk_len, 1)
+
+    def check(self, song):
+        # Whether the local file is the song committed on chain, before paying for it
+        self.song_id, self.song_name, self.song_auth, self.song_p = song
+        self.load_song()
+        try:
+            self.store.add(self.song_id, self.filename, load_index(f'{os.path.splitext(self.filename)[0]}.idx'))
+        except ValueError as e:
+            print(e)
+            return False
+        self.index = self.store.get_layout(self.song_id) or []
+        if self.store.chunks_len(self.song_id) != self.chunks_len or os.path.getsize(self.filename) != self.length:
+            return False
+        return all(self.is_valid(i, self.store.get_chunk(self.song_id, i), self.get_proof(i))
+            for i in range(self.chunks_len))
+
+    def get_proof(self, index):
+        return self.store.get_proof(self.song_id, index) if self.root else None
+
+    def setup(self, dist):
+        self.dist = dist
+        self.dist_name = self.chain.get_user_info(dist)[1]
+        if self.song_id not in self.store and not self.check((self.song_id, self.song_name, self.song_auth, self.song_p)):
+            raise Exception(f'Local copy of {self.song_name} is not valid')
+
+    def create(self, song, distributor=None):
+        super().create(song, self.chain.account.address)
+
+    def connect(self):
+        return None
+
+    def send_request(self, index):
+        self.pending.append((index, time.monotonic()))
+
+    def recv_response(self):
+        index, _ = self.pending.popleft()
+        return index, bytes(self.store.get_chunk(self.song_id, index)), self.get_proof(index)
+
+    def close(self):
+        super().close()
+        self.store.close()
@@ -0,0 +1,175 @@
+import time
+import ctypes
+import threading
+# Bytes of audio kept in memory ahead of the player
+RING_CAPACITY = 1 << 20
+
+class RingBuffer:
+    def __init__(self, capacity=RING_CAPACITY):
+        self.data = bytearray(capacity)
+        self.capacity = capacity
+        self.head = 0
+        self.size = 0
+        self.finished = False
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def write(self, chunk):
+        chunk = memoryview(chunk)
+        with self.cond:
+            while len(chunk) and not self.closed:
+                # Wait for the player to consume some audio
+                self.cond.wait_for(lambda: self.size < self.capacity or self.closed)
+                if self.closed:
+                    break
+                tail = (self.head + self.size) % self.capacity
+                n = min(len(chunk), self.capacity - self.size, self.capacity - tail)
+                self.data[tail:tail+n] = chunk[:n]
+                self.size += n
+                chunk = chunk[n:]
+                self.cond.notify_all()
+
+    def read(self, n):
+        with self.cond:
+            self.cond.wait_for(lambda: self.size or self.finished or self.closed)
+            if self.closed:
+                return b''
+            # Consumed bytes are released for new chunks
+            n = min(n, self.size, self.capacity - self.head)
+            data = bytes(self.data[self.head:self.head+n])
+            self.head = (self.head + n) % self.capacity
+            self.size -= n
+            self.cond.notify_all()
+            return data
+
+    def finish(self):
+        with self.cond:
+            self.finished = True
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+class VlcSink:
+    def __init__(self, session, capacity=RING_CAPACITY):
+        # Only imported when audio is actually played
+        import vlc
+        self.ring = RingBuffer(capacity)
+        self.length = session.length
+        # Feed the player from memory through libvlc_media_new_callbacks,
+        # callbacks must be referenced for as long as the media is alive
+        # and the stream is not seekable
+        self.callbacks = (
+            vlc.CallbackDecorators.MediaOpenCb(self.media_open),
+            vlc.CallbackDecorators.MediaReadCb(self.media_read),
+            None,
+            vlc.CallbackDecorators.MediaCloseCb(self.media_close)
+        )
+        self.instance = vlc.Instance()
+        self.media = self.instance.media_new_callbacks(*self.callbacks, None)
+        self.player = self.instance.media_player_new()
+        self.player.set_media(self.media)
+        self.events = self.player.event_manager()
+        self.event_types = vlc.EventType
+
+    def media_open(self, opaque, datap, sizep):
+        sizep[0] = self.length
+        return 0
+
+    def media_read(self, opaque, buf, n):
+        # Blocks while the player is ahead of the downloaded audio
+        data = self.ring.read(n)
+        ctypes.memmove(buf, data, len(data))
+        return len(data)
+
+    def media_close(self, opaque):
+        pass
+
+    def on_event(self, callback):
+        self.events.event_attach(self.event_types.MediaPlayerPositionChanged, lambda e: callback(False))
+        self.events.event_attach(self.event_types.MediaPlayerEndReached, lambda e: callback(True))
+
+    def write(self, chunk):
+        self.ring.write(chunk)
+
+    def finish(self):
+        self.ring.finish()
+
+    def play(self):
+        self.player.play()
+
+    def pause(self):
+        self.player.set_pause(1)
+
+    def is_playing(self):
+        return self.player.is_playing()
+
+    def get_time(self):
+        return max(self.player.get_time(), 0)
+
+    def stop(self):
+        # Unblock the player's reads before stopping it
+        self.ring.close()
+        self.player.stop()
+        # Every song has its own libvlc instance, freed with it
+        self.player.release()
+        self.media.release()
+        self.instance.release()
+
+class NullSink:
+    # Discards audio while keeping a simulated playhead, for headless runs
+    def __init__(self, session, speed=1.0, tick=0.25):
+        self.session = session
+        self.speed = speed
+        self.tick = tick
+        self.loaded = 0
+        self.played = 0
+        self.started = None
+        self.callbacks = []
+        self.stopped = threading.Event()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def on_event(self, callback):
+        self.callbacks.append(callback)
+
+    def write(self, chunk):
+        self.loaded += len(chunk)
+
+    def finish(self):
+        pass
+
+    def play(self):
+        if self.started is None:
+            self.started = time.monotonic()
+
+    def pause(self):
+        self.played = self.get_time()
+        self.started = None
+
+    def is_playing(self):
+        return self.started is not None
+
+    def get_time(self):
+        if self.started is None:
+            return self.played
+        now = time.monotonic()
+        played = self.played + (now - self.started) * 1000 * self.speed
+        buffered = self.session.duration * 1000 * self.loaded / self.session.length
+        if played > buffered:
+            # Playhead stalls once it reaches the end of the audio received
+            self.played, self.started = buffered, now
+            return buffered
+        return played
+
+    def stop(self):
+        self.pause()
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(self.tick):
+            if self.is_playing():
+                ended = self.get_time() >= self.session.duration * 1000
+                for callback in self.callbacks:
+                    callback(ended)
@@ -0,0 +1,113 @@
+import os
+import mmap
+import threading
+from collections import OrderedDict
+from src.merkle import chunk_hash, leaf_hash, merkle_levels, merkle_proof
+from src.mp3 import pack_index, unpack_index
+
+def load_index(filename):
+    # Chunk layout of songs cut on MP3 frames
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'rb') as f:
+        return unpack_index(f.read())
+
+class ChunkStore:
+    def __init__(self, chunk_len, max_open=64):
+        self.chunk_len = chunk_len
+        self.max_open = max_open
+        self.files = {}
+        # Memory maps of the most recently requested songs
+        self.maps = OrderedDict()
+        # Merkle trees of songs committed by their root, dropped with their map
+        self.trees = {}
+        # Maps evicted while chunks of them were still being sent
+        self.retired = []
+        self.lock = threading.Lock()
+
+    def __contains__(self, id):
+        return id in self.files
+
+    def add(self, id, filename, index=None):
+        # Only the file size and chunk layout are needed until the song is requested,
+        # songs without index are cut every chunk_len bytes
+        size = os.path.getsize(filename)
+        if size == 0:
+            # Empty files can not be mapped
+            raise ValueError(f'{filename} is empty')
+        if index and index[-1][0] != size:
+            # Layout of another version of the file, its chunks would not match the song's hashes
+            raise ValueError(f'Chunk index does not match {filename}')
+        self.files[id] = (filename, size, index)
+
+    def remove(self, id):
+        self.files.pop(id, None)
+        self.trees.pop(id, None)
+        with self.lock:
+            self.release(self.maps.pop(id, None))
+
+    def chunks_len(self, id):
+        _, size, index = self.files[id]
+        return len(index) - 1 if index else -(-size // self.chunk_len)
+
+    def get_chunk(self, id, i):
+        if not 0 <= i < self.chunks_len(id):
+            raise IndexError('chunk index out of range')
+        index = self.files[id][2]
+        if index:
+            start, end = index[i][0], index[i+1][0]
+        else:
+            start, end = i * self.chunk_len, (i+1) * self.chunk_len
+        return memoryview(self.map(id))[start:end]
+
+    def get_layout(self, id):
+        # Offsets and start times of the chunks, None for songs cut every chunk_len bytes
+        return self.files[id][2]
+
+    def get_index(self, id):
+        index = self.files[id][2]
+        return pack_index(index) if index else b''
+
+    def get_proof(self, id, index):
+        tree = self.trees.get(id)
+        if tree is None:
+            # Built from the file the first time a proof is needed while the song is mapped
+            tree = merkle_levels(leaf_hash(chunk_hash(self.get_chunk(id, i))) for i in range(self.chunks_len(id)))
+            with self.lock:
+                if id in self.maps:
+                    self.trees[id] = tree
+        return merkle_proof(tree, index)
+
+    def map(self, id):
+        with self.lock:
+            if id in self.maps:
+                self.maps.move_to_end(id)
+                return self.maps[id]
+            with open(self.files[id][0], 'rb') as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[id] = m
+            # Close least recently used songs
+            while len(self.maps) > self.max_open:
+                old, old_map = self.maps.popitem(last=False)
+                self.trees.pop(old, None)
+                self.release(old_map)
+            return m
+
+    def release(self, m):
+        # Maps still being sent are closed on a later release, once their last view is gone
+        if m is not None:
+            self.retired.append(m)
+        busy = []
+        for m in self.retired:
+            try:
+                m.close()
+            except BufferError:
+                busy.append(m)
+        self.retired = busy
+
+    def close(self):
+        with self.lock:
+            self.trees.clear()
+            while self.maps:
+                self.release(self.maps.popitem()[1])
+            self.release(None)
@@ -1,25 +1,38 @@
 import os
+import mmap
+import shutil
 import hashlib
 from mutagen.mp3 import MP3
+from src.merkle import leaf_hash, merkle_root
+from src.mp3 import chunk_index, pack_index
 
 def keccak(data):
     return '0x' + hashlib.sha3_256(data).hexdigest()
 
 class Upload():
-    def __init__(self, filename, chunk_len):
-        with open(filename, 'rb') as fd:
+    def __init__(self, filename, chunk_len, merkle=False, name=None, price=None, chunk_ms=None):
+        self.filename = filename
+        with open(filename, 'rb') as fd, mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as data:
             # Get data's length
-            data = fd.read()
-            self.data = data
             self.length = len(data)
-            # Double hash each chunk
-            self.chunks = [keccak(data[i:i+chunk_len]) for i in range(0, len(data), chunk_len)]
+            # Cut chunks on MP3 frames when a chunk duration is given,
+            # otherwise every chunk_len bytes
+            self.index = chunk_index(data, chunk_ms) if chunk_ms else None
+            if self.index:
+                bounds = [offset for offset,_ in self.index]
+            else:
+                bounds = list(range(0, len(data), chunk_len)) + [len(data)]
+            # Hash each chunk straight from the mapped file
+            self.chunks = [keccak(data[start:end]) for start,end in zip(bounds, bounds[1:])]
+        # Commit to the chunk hashes by their Merkle root only
+        self.root = merkle_root([leaf_hash(bytes.fromhex(c[2:])) for c in self.chunks]) if merkle else None
         # Get song's duration
         self.duration = MP3(filename).info.length
-        # Get song's name and price from user input
-        print()
-        self.name = input("Song's name: ")
-        self.price = self.input_float("Song's price (in Mi): ")
+        # Get song's name and price from user input when not given
+        if name is None or price is None:
+            print()
+        self.name = name if name is not None else input("Song's name: ")
+        self.price = price if price is not None else self.input_float("Song's price (in Mi): ")
 
     def input_float(self, msg):
         while True:
@@ -32,10 +45,11 @@ class Upload():
         # Save data to downloads
         if not os.path.exists('downloads'):
             os.makedirs('downloads')
-        with open(f'downloads/{self.id}.mp3', 'wb') as fd:
-            fd.seek(0)
-            fd.truncate()
-            fd.write(self.data)
+        shutil.copyfile(self.filename, f'downloads/{self.id}.mp3')
+        # Chunk layout is served to listeners along with the song
+        if self.index:
+            with open(f'downloads/{self.id}.idx', 'wb') as fd:
+                fd.write(pack_index(self.index))
 
     def pprint(self, username):
         print(f"""
@@ -46,5 +60,6 @@ New song uploaded: {self.name} by {username}
     duration: {self.duration}
     length:   {self.length}
     chunks:   {len(self.chunks)}
+    root:     {'0x'+self.root.hex() if self.root else '-'}
 
         """)
\ No newline at end of file
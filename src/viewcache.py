@@ -0,0 +1,95 @@
+import time
+import threading
+from collections import OrderedDict
+# Seconds the latest block number is trusted before it is read again
+BLOCK_AGE = 0.25
+# Most answers kept that never change once read
+MAX_IMMUTABLE = 10000
+# Calls whose answers are kept up to date by the event index and the server's
+# session cache, read again every time they reach the contract
+UNCACHED = {'is_chunk_paid', 'paid_bitmap', 'sessions'}
+# Calls whose answers may change with each transaction we send
+TOUCHED_BY = {
+    'create_user': {'users'},
+    'deposit': {'users'},
+    'withdraw': {'users'},
+    'edit_url': {'users'},
+    'upload_song': {'users', 'songs', 'song_count', 'song_list', 'song_page'},
+    'upload_song_merkle': {'users', 'songs', 'song_count', 'song_list', 'song_page'},
+    'edit_price': {'songs', 'song_page'},
+    'manage_validation': {'songs', 'song_page'},
+    'distribute': {'is_distributing', 'get_distributors', 'get_rand_distributor'},
+    'undistribute': {'is_distributing', 'get_distributors', 'get_rand_distributor'},
+    'create_session': {'users'},
+    'get_chunk': {'users'},
+    'close_session': {'users'}
+}
+
+class ViewCache:
+    # Answers of contract calls by call and arguments, valid for the block they
+    # were read at, and an LRU of answers that can never change
+    def __init__(self, w3, block_age=BLOCK_AGE, max_immutable=MAX_IMMUTABLE):
+        self.w3 = w3
+        self.block_age = block_age
+        self.max_immutable = max_immutable
+        self.block = None
+        self.checked = 0
+        # Changes with every new block and every transaction mined
+        self.version = 0
+        self.entries = {}
+        self.immutable = OrderedDict()
+        self.lock = threading.Lock()
+
+    def head(self):
+        # Forget every answer once a new block is built, the block number
+        # is read at most once every block_age seconds
+        if time.monotonic() - self.checked > self.block_age:
+            block = self.w3.eth.block_number
+            with self.lock:
+                if block != self.block:
+                    self.block = block
+                    self.version += 1
+                    self.entries.clear()
+                self.checked = time.monotonic()
+
+    def get(self, key, read):
+        if key[0] in UNCACHED:
+            return read()
+        self.head()
+        with self.lock:
+            if key in self.entries:
+                return self.entries[key]
+            version = self.version
+        value = read()
+        with self.lock:
+            # Not kept if a transaction or a new block came in while reading
+            if self.version == version:
+                self.entries[key] = value
+        return value
+
+    def get_immutable(self, key, read, keep=lambda value: True):
+        with self.lock:
+            if key in self.immutable:
+                self.immutable.move_to_end(key)
+                return self.immutable[key]
+        value = read()
+        # Answers about what does not exist yet may still change
+        if keep(value):
+            with self.lock:
+                self.immutable[key] = value
+                while len(self.immutable) > self.max_immutable:
+                    self.immutable.popitem(last=False)
+        return value
+
+    def invalidate(self, fn_name):
+        # Our transaction is mined, forget what it may have changed
+        names = TOUCHED_BY.get(fn_name)
+        with self.lock:
+            if names is None:
+                self.entries.clear()
+            else:
+                for key in [k for k in self.entries if k[0] in names]:
+                    del self.entries[key]
+            # Gas is paid from the on-chain balance by every transaction
+            self.entries.pop(('balance',), None)
+            self.version += 1
@@ -0,0 +1,17 @@
+from src.bitmap import to_bitmap, from_bitmap, from_words
+
+def test_round_trip():
+    for indices in [set(), {0}, {1, 5, 63}, set(range(0, 1000, 7))]:
+        assert from_bitmap(to_bitmap(indices)) == indices
+
+def test_words_hold_256_chunks():
+    # Chunk i is bit i % 256 of word i // 256, as set by the contract
+    indices = {0, 255, 256, 300, 511, 512}
+    words = [0] * 3
+    for i in indices:
+        words[i // 256] |= 1 << (i % 256)
+    assert from_words(words, 600) == indices
+
+def test_words_past_the_song_are_ignored():
+    assert from_words([1 | 1 << 200], 100) == {0}
+    assert from_words([], 10) == set()
@@ -0,0 +1,34 @@
+from src.merkle import chunk_hash, leaf_hash, merkle_levels, merkle_root, merkle_proof, verify_proof
+
+def leaves(count):
+    return [leaf_hash(chunk_hash(bytes([i]) * 100)) for i in range(count)]
+
+def test_every_proof_verifies():
+    for count in range(1, 18):
+        levels = merkle_levels(leaves(count))
+        root = merkle_root(leaves(count))
+        for i in range(count):
+            assert verify_proof(levels[0][i], i, count, merkle_proof(levels, i), root)
+
+def test_wrong_leaf_index_or_count():
+    levels = merkle_levels(leaves(5))
+    root = levels[-1][0]
+    proof = merkle_proof(levels, 2)
+    assert not verify_proof(levels[0][3], 2, 5, proof, root)
+    assert not verify_proof(levels[0][2], 3, 5, proof, root)
+    assert not verify_proof(levels[0][2], 2, 4, proof, root)
+    assert not verify_proof(levels[0][2], 5, 5, proof, root)
+
+def test_truncated_or_padded_proof():
+    levels = merkle_levels(leaves(8))
+    root = levels[-1][0]
+    proof = merkle_proof(levels, 6)
+    assert not verify_proof(levels[0][6], 6, 8, proof[:-32], root)
+    assert not verify_proof(levels[0][6], 6, 8, proof + levels[0][0], root)
+    assert not verify_proof(levels[0][6], 6, 8, proof[:-1], root)
+
+def test_node_is_not_a_chunk():
+    # Two sibling leaves sent as one chunk do not hash to their parent
+    levels = merkle_levels(leaves(4))
+    chunk = levels[0][0] + levels[0][1]
+    assert not verify_proof(leaf_hash(chunk_hash(chunk)), 0, 2, levels[1][1], levels[-1][0])
@@ -0,0 +1,48 @@
+from src.mp3 import parse_header, frames, chunk_index, pack_index, unpack_index, ENTRY
+# MPEG1 layer III, 128 kbps, 44100 Hz, no padding
+HEADER = b'\xff\xfb\x90\x00'
+FRAME_LEN = 417
+FRAME_S = 1152 / 44100
+
+def song(count, tag=b''):
+    return tag + (HEADER + bytes(FRAME_LEN - 4)) * count
+
+def id3(size):
+    # Tag size is stored in 7 bits per byte
+    return b'ID3\x04\x00\x00' + bytes([size >> 21 & 0x7f, size >> 14 & 0x7f, size >> 7 & 0x7f, size & 0x7f]) + bytes(size)
+
+def test_parse_header():
+    assert parse_header(HEADER, 0) == (FRAME_LEN, 1152, 44100)
+    assert parse_header(b'\xff\xfb\x92\x00', 0)[0] == FRAME_LEN + 1
+    assert parse_header(b'\x00\xfb\x90\x00', 0) is None
+    assert parse_header(HEADER[:3], 0) is None
+
+def test_frames_skip_tag_and_stray_bytes():
+    data = song(3, id3(200))
+    data = data[:210 + FRAME_LEN] + b'junk' + data[210 + FRAME_LEN:]
+    assert [offset for offset,_ in frames(data)] == [210, 214 + FRAME_LEN, 214 + 2 * FRAME_LEN]
+
+def test_chunk_index_cuts_on_frames():
+    data = song(100, id3(50))
+    index = chunk_index(data, 500)
+    offsets = [offset for offset,_ in index]
+    assert offsets[0] == 0 and offsets[-1] == len(data)
+    assert all((offset - 60) % FRAME_LEN == 0 for offset in offsets[1:-1])
+    # Every chunk but the last holds at least 500 ms
+    times = [ms for _,ms in index]
+    assert all(b - a >= 500 for a,b in zip(times[:-2], times[1:-1]))
+    assert times[-1] == round(100 * FRAME_S * 1000)
+
+def test_chunk_index_without_frames():
+    assert chunk_index(bytes(1000), 500) is None
+
+def test_pack_round_trip():
+    index = chunk_index(song(40), 250)
+    data = pack_index(index)
+    assert len(data) == len(index) * ENTRY.size
+    assert unpack_index(data) == index
+
+def test_unpack_invalid():
+    assert unpack_index(b'') is None
+    assert unpack_index(None) is None
+    assert unpack_index(bytes(ENTRY.size + 1)) is None